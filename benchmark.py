@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Benchmarks of the common calamari_client workflows against fake_calamari
+
+    python benchmark.py --osds 10000 --servers 500 --latency 0.002
+    python benchmark.py --json baseline.json
+    python benchmark.py --compare baseline.json --tolerance 0.2
+
+For every workflow: wall time per run (median / p95 / max), HTTP requests
+and response bytes per run, requests per second served by the fake server,
+and peak Python memory of one run. The *_plain workflows use the stdlib
+JSON decoder without compression, to compare with the default codecs.
+The *_overloaded workflows make the fake server answer 503 to the requests
+over half the workers in flight, without and with AIMDLimiter + RetryPolicy.
+"""
+
+import argparse
+import collections
+import json
+import sys
+import time
+import tracemalloc
+
+import calamari_client as cc
+import fake_calamari
+
+
+WORKFLOWS = collections.OrderedDict()
+
+
+def workflow(name):
+    def register(func):
+        WORKFLOWS[name] = func
+        return func
+    return register
+
+
+class Context(object):
+    def __init__(self, url, fake, args):
+        self.url = url
+        self.fake = fake
+        self.args = args
+        # client side JSON decode time, from the decode events
+        self.decode_seconds = 0.0
+        # failed items of the bulk workflows
+        self.errors = 0
+        self.instrumentation = cc.Instrumentation()
+        self.instrumentation.add_hook(self.on_event)
+        self.connection = cc.CalamariAPIv2Connection(url, fake.username, fake.password,
+                                                     max_workers=args.workers, instrumentation=self.instrumentation)
+        self.fsid = self.connection.cluster_list()[0]['id']
+        self.osd_ids = [osd['id'] for osd in self.connection.cluster_osd_list(self.fsid)][:args.sample]
+        self.fqdns = [server['fqdn'] for server in self.connection.server_list()][:args.sample]
+        # stdlib json decoder, no compression
+        self.plain_connection = cc.CalamariAPIv2Connection(url, fake.username, fake.password,
+                                                           max_workers=args.workers, json_decoder=json.loads,
+                                                           instrumentation=self.instrumentation)
+        self.plain_connection.headers['Accept-Encoding'] = 'identity'
+        # adaptive concurrency, retries with backoff
+        self.adaptive_connection = cc.CalamariAPIv2Connection(url, fake.username, fake.password,
+                                                              max_workers=args.workers,
+                                                              instrumentation=self.instrumentation,
+                                                              limiter=cc.AIMDLimiter(max_limit=args.workers),
+                                                              retry=cc.RetryPolicy(retries=5))
+
+    def on_event(self, event):
+        if event['type'] == 'decode':
+            self.decode_seconds += event['seconds']
+
+
+@workflow('osd_list')
+def osd_list(ctx):
+    ctx.connection.cluster_osd_list(ctx.fsid)
+
+
+@workflow('osd_records')
+def osd_records(ctx):
+    ctx.connection.cluster_osd_records(ctx.fsid).by_id(ctx.osd_ids[-1])
+
+
+@workflow('osd_get_sequential')
+def osd_get_sequential(ctx):
+    for osd_id in ctx.osd_ids:
+        ctx.connection.cluster_osd_get(ctx.fsid, osd_id)
+
+
+@workflow('osd_get_many')
+def osd_get_many(ctx):
+    ctx.connection.cluster_osd_get_many(ctx.fsid, ctx.osd_ids)
+
+
+@workflow('osd_get_async')
+def osd_get_async(ctx):
+    try:
+        import asyncio
+        import calamari_client_aio as cca
+    except ImportError:
+        return False
+
+    async def run():
+        async with cca.AsyncCalamariAPIv2Connection(ctx.url, ctx.fake.username, ctx.fake.password,
+                                                    concurrency=ctx.args.workers) as connection:
+            await connection.authenticate()
+            await asyncio.gather(*[connection.cluster_osd_get(ctx.fsid, osd_id) for osd_id in ctx.osd_ids])
+    asyncio.run(run())
+
+
+@workflow('sync_object_osd_map')
+def sync_object_osd_map(ctx):
+    ctx.connection.cluster_sync_object_get(ctx.fsid, 'osd_map')
+
+
+@workflow('cluster_snapshot')
+def cluster_snapshot(ctx):
+    ctx.connection.cluster_snapshot(ctx.fsid)
+
+
+@workflow('sync_object_osd_map_plain')
+def sync_object_osd_map_plain(ctx):
+    ctx.plain_connection.cluster_sync_object_get(ctx.fsid, 'osd_map')
+
+
+def overloaded(ctx, connection):
+    ctx.fake.max_concurrent = max(1, ctx.args.workers // 2)
+    try:
+        results = connection.cluster_osd_get_many(ctx.fsid, ctx.osd_ids)
+    finally:
+        ctx.fake.max_concurrent = None
+    ctx.errors += sum(1 for result in results if result.error is not None)
+
+
+@workflow('osd_get_many_overloaded')
+def osd_get_many_overloaded(ctx):
+    overloaded(ctx, ctx.connection)
+
+
+@workflow('osd_get_many_overloaded_adaptive')
+def osd_get_many_overloaded_adaptive(ctx):
+    overloaded(ctx, ctx.adaptive_connection)
+
+
+@workflow('info_cached')
+def info_cached(ctx):
+    if ctx.connection.cache is None:
+        ctx.connection.cache = cc.ResponseCache()
+    for _ in range(100):
+        ctx.connection.info()
+
+
+@workflow('server_cpu_sequential')
+def server_cpu_sequential(ctx):
+    for fqdn in ctx.fqdns:
+        ctx.connection.server_cpu_data(fqdn, time_from='-1d')
+
+
+@workflow('server_cpu_batch')
+def server_cpu_batch(ctx):
+    ctx.connection.graphite_batch_get([('server_cpu_data', fqdn) for fqdn in ctx.fqdns], time_from='-1d')
+
+
+@workflow('iops_7d_json')
+def iops_7d_json(ctx):
+    ctx.connection.iops_data(ctx.fsid, time_from='-7d')
+
+
+@workflow('render_1d_wide')
+def render_1d_wide(ctx):
+    params = [('target', 'servers.%s.cpu.total.*' % (cc.graphite_host(fqdn), )) for fqdn in ctx.fqdns[:20]]
+    ctx.connection.graphite_data_get(params + [('from', '-1d')])
+
+
+@workflow('render_1d_wide_plain')
+def render_1d_wide_plain(ctx):
+    params = [('target', 'servers.%s.cpu.total.*' % (cc.graphite_host(fqdn), )) for fqdn in ctx.fqdns[:20]]
+    ctx.plain_connection.graphite_data_get(params + [('from', '-1d')])
+
+
+@workflow('iops_7d_frame')
+def iops_7d_frame(ctx):
+    if cc.numpy is None:
+        return False
+    ctx.connection.iops_data(ctx.fsid, time_from='-7d', as_frame=True)
+
+
+@workflow('iops_7d_sparkline')
+def iops_7d_sparkline(ctx):
+    ctx.connection.iops_data(ctx.fsid, time_from='-7d', max_points=300)
+
+
+@workflow('disk_iops_top_loop')
+def disk_iops_top_loop(ctx):
+    scores = []
+    for fqdn in ctx.fqdns:
+        for disk in ctx.connection.graphite_metrics_find('servers.%s.iostat.*' % (cc.graphite_host(fqdn), )):
+            data = ctx.connection.server_disk_detail_data(disk['id'])
+            values = [row[5] for row in data['datapoints'] if row[5] is not None]
+            if values:
+                scores.append((sum(values) / len(values), disk['id']))
+    sorted(scores, reverse=True)[:10]
+
+
+@workflow('disk_iops_top_fleet')
+def disk_iops_top_fleet(ctx):
+    if cc.numpy is None:
+        return False
+    ctx.connection.graphite_fleet_top('servers.*.iostat.*.iops', k=10)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run_workflow(ctx, name, func, repeat):
+    if func(ctx) is False:  # warm up, or unavailable
+        return None
+    timings = []
+    requests_before, bytes_before = ctx.fake.request_count, ctx.fake.bytes_sent
+    ctx.decode_seconds = 0.0
+    ctx.errors = 0
+    for _ in range(repeat):
+        start = time.time()
+        func(ctx)
+        timings.append(time.time() - start)
+    request_count = ctx.fake.request_count - requests_before
+    byte_count = ctx.fake.bytes_sent - bytes_before
+    decode_seconds = ctx.decode_seconds
+    tracemalloc.start()
+    func(ctx)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    total = sum(timings)
+    return {
+        'median': percentile(timings, 0.5),
+        'p95': percentile(timings, 0.95),
+        'max': max(timings),
+        'requests_per_run': request_count / float(repeat),
+        'bytes_per_run': byte_count / float(repeat),
+        'decode_per_run': decode_seconds / repeat,
+        'errors_per_run': ctx.errors / float(repeat),
+        'requests_per_second': request_count / total if total else 0.0,
+        'peak_memory_bytes': peak,
+    }
+
+
+def print_results(results):
+    print('%-34s %10s %10s %10s %8s %10s %10s %8s %10s %10s' % (
+        'workflow', 'median ms', 'p95 ms', 'max ms', 'req/run', 'KiB/run', 'decode ms', 'err/run', 'req/s',
+        'peak KiB'))
+    for name, result in results.items():
+        if result is None:
+            print('%-34s %10s' % (name, 'skipped'))
+            continue
+        print('%-34s %10.2f %10.2f %10.2f %8.1f %10.1f %10.2f %8.1f %10.1f %10.1f' % (
+            name, result['median'] * 1000, result['p95'] * 1000, result['max'] * 1000,
+            result['requests_per_run'], result.get('bytes_per_run', 0) / 1024.0,
+            result.get('decode_per_run', 0) * 1000, result.get('errors_per_run', 0),
+            result['requests_per_second'],
+            result['peak_memory_bytes'] / 1024.0))
+
+
+def compare(results, baseline, tolerance):
+    """
+    Names of the workflows whose median time regressed by more than tolerance
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if result is None or base is None:
+            continue
+        if result['median'] > base['median'] * (1 + tolerance):
+            regressions.append(name)
+            print('REGRESSION %s: median %.2f ms -> %.2f ms' % (
+                name, base['median'] * 1000, result['median'] * 1000))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='calamari_client benchmarks')
+    parser.add_argument('--osds', type=int, default=2000)
+    parser.add_argument('--servers', type=int, default=100)
+    parser.add_argument('--graphite-days', type=int, default=7)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--sample', type=int, default=200,
+                        help='number of OSDs / servers used by the per-item workflows')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', action='append', choices=list(WORKFLOWS), help='run only these workflows')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--compare', help='baseline results file, exit 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed median slowdown for --compare')
+    args = parser.parse_args()
+
+    fake = fake_calamari.FakeCalamari(osds=args.osds, servers=args.servers,
+                                      graphite_days=args.graphite_days, latency=args.latency)
+    server, url = fake_calamari.serve_in_thread(fake)
+    ctx = Context(url, fake, args)
+    results = collections.OrderedDict()
+    for name in args.only or WORKFLOWS:
+        results[name] = run_workflow(ctx, name, WORKFLOWS[name], args.repeat)
+    server.shutdown()
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
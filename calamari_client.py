@@ -1,44 +1,1225 @@
 #!/usr/bin/env python
 #-*- coding: utf-8 -*-
 
+import bisect
+import collections
+import fnmatch
+import hashlib
 import json
 import logging
+import mmap
+import os
+import random
+import re
+import sys
+import threading
+import time
+import warnings
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import str as text_type, urlencode
+
+try:
+    import numpy
+except ImportError:  # optional, for GraphiteFrame / GraphiteStore only
+    numpy = None
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, GraphiteStore is then only thread-safe
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:  # optional, faster JSON decoding
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # optional, used if orjson is missing
+    ujson = None
 
 
 LOG = logging.getLogger(__name__)
 
+# One item of a bulk (*_many) call: the requested key, and either the
+# decoded data or the exception raised while fetching it
+BulkResult = collections.namedtuple('BulkResult', ['key', 'data', 'error'])
+
+_now = getattr(time, 'monotonic', time.time)
+
+if orjson is not None:
+    JSON_LIBRARY, _fast_json_loads = 'orjson', orjson.loads
+elif ujson is not None:
+    JSON_LIBRARY, _fast_json_loads = 'ujson', ujson.loads
+else:
+    JSON_LIBRARY, _fast_json_loads = 'json', None
+
+
+def json_loads(data):
+    """
+    Decode a JSON document (bytes or text) with the fastest decoder
+    installed, see JSON_LIBRARY
+
+    Documents the fast decoders reject (e.g. NaN) are decoded again by
+    the json module, which raises the ValueError if they are invalid.
+    """
+    if _fast_json_loads is not None:
+        try:
+            return _fast_json_loads(data)
+        except ValueError:
+            pass
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+_GRAPHITE_UNITS = [
+    ('s', 1), ('min', 60), ('h', 3600), ('d', 86400),
+    ('w', 7 * 86400), ('mon', 30 * 86400), ('y', 365 * 86400),
+]
+_graphite_offset_re = re.compile(r'^-(\d+)([a-z]+)$')
+
+
+def graphite_time_offset(value):
+    """
+    Length in seconds of a relative graphite time (e.g. '-12hour', '-1d'),
+    None for absolute times
+    """
+    match = _graphite_offset_re.match(str(value).strip().lower())
+    if not match:
+        return None
+    number, unit = match.groups()
+    for prefix, seconds in sorted(_GRAPHITE_UNITS, key=lambda u: -len(u[0])):
+        if unit.startswith(prefix):
+            return int(number) * seconds
+    return None
+
+
+# the wrappers added by graphite_consolidate_params, as sent or as named by
+# graphite-web in its responses, e.g. summarize(x, "60s", "avg", true)
+_graphite_summarize_re = re.compile(r'^summarize\((.*),\s*["\'](\d+)s["\'],\s*["\'](\w+)["\'],\s*true\)$')
+_graphite_consolidate_by_re = re.compile(r'^consolidateBy\((.*),\s*["\'](\w+)["\']\)$')
+# consolidateBy() function: summarize() function
+_GRAPHITE_CONSOLIDATIONS = {'average': 'avg', 'sum': 'sum', 'min': 'min', 'max': 'max'}
+
+
+def graphite_unwrap_target(target):
+    """
+    Target without the consolidation wrappers of graphite_consolidate_params
+    """
+    while True:
+        match = _graphite_consolidate_by_re.match(target) or _graphite_summarize_re.match(target)
+        if match is None:
+            return target
+        target = match.group(1)
+
+
+def graphite_host(fqdn):
+    """
+    Graphite (diamond) path segment of a server: its fqdn, dots as underscores
+    """
+    return fqdn.replace('.', '_')
+
+
+class GraphiteFrame(object):
+    """
+    Columnar graph data backed by numpy arrays
+
+    :attr targets: target names, the column labels of values
+    :attr timestamps: int64 array of shape (n, ), ascending
+    :attr values: float64 array of shape (n, len(targets)), NaN for gaps
+    """
+    __slots__ = ('targets', 'timestamps', 'values')
+
+    def __init__(self, targets, timestamps, values):
+        self.targets = list(targets)
+        self.timestamps = timestamps
+        self.values = values
+
+    def __repr__(self):
+        return '<%s: %d points x %d targets>' % (
+            self.__class__.__name__, len(self.timestamps), len(self.targets))
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Build a frame from the json-array payload {'targets', 'datapoints'}
+        """
+        if numpy is None:
+            raise ImportError('numpy is required for GraphiteFrame')
+        targets = data['targets']
+        if not data['datapoints']:
+            return cls(targets, numpy.empty(0, dtype=numpy.int64),
+                       numpy.empty((0, len(targets)), dtype=numpy.float64))
+        # None is decoded to NaN by numpy for float arrays
+        array = numpy.array(data['datapoints'], dtype=numpy.float64)
+        return cls(targets, array[:, 0].astype(numpy.int64), array[:, 1:])
+
+    @classmethod
+    def from_series(cls, targets, series):
+        """
+        Align per-target (timestamps, values) arrays on the union of their timestamps
+        """
+        if numpy is None:
+            raise ImportError('numpy is required for GraphiteFrame')
+        if series:
+            timestamps = numpy.unique(numpy.concatenate([ts for ts, _ in series])).astype(numpy.int64)
+        else:
+            timestamps = numpy.empty(0, dtype=numpy.int64)
+        values = numpy.full((len(timestamps), len(targets)), numpy.nan)
+        for i, (ts, vs) in enumerate(series):
+            values[numpy.searchsorted(timestamps, ts), i] = vs
+        return cls(targets, timestamps, values)
+
+    def to_json(self):
+        """
+        Back to the json-array payload, NaN as None
+        """
+        values = self.values.astype(object)
+        values[numpy.isnan(self.values)] = None
+        return {'targets': list(self.targets),
+                'datapoints': [[ts] + row for ts, row in zip(self.timestamps.tolist(), values.tolist())]}
+
+    def column(self, target):
+        return self.values[:, self.targets.index(target)]
+
+    def between(self, start=None, end=None):
+        """
+        Points with start <= timestamp < end, as views of this frame's arrays
+        """
+        lo = 0 if start is None else numpy.searchsorted(self.timestamps, start, side='left')
+        hi = len(self.timestamps) if end is None else numpy.searchsorted(self.timestamps, end, side='left')
+        return self.__class__(self.targets, self.timestamps[lo:hi], self.values[lo:hi])
+
+    def downsample(self, max_points=None, step=None, how='average'):
+        """
+        Consolidate the points into buckets of `step` seconds, aligned on the
+        first timestamp, ignoring NaN
+
+        :arg max_points: without step, use the smallest multiple of the
+                         current step giving at most max_points buckets
+        :arg how: 'average', 'sum', 'min' or 'max'
+        :return: a new frame, or this one if there is nothing to do
+        """
+        if how not in _GRAPHITE_CONSOLIDATIONS:
+            raise ValueError('Unknown consolidation %r' % (how, ))
+        count = len(self.timestamps)
+        if count < 2:
+            return self
+        native = int(numpy.diff(self.timestamps).min())
+        if step is None:
+            if max_points is None or count <= max_points:
+                return self
+            span = int(self.timestamps[-1] - self.timestamps[0]) + native
+            step = native * -(-span // (native * max_points))
+        elif step <= native:
+            return self
+        first = self.timestamps[0]
+        buckets = first + (self.timestamps - first) // step * step
+        starts = numpy.flatnonzero(numpy.r_[True, buckets[1:] != buckets[:-1]])
+        valid = ~numpy.isnan(self.values)
+        counts = numpy.add.reduceat(valid, starts, axis=0)
+        if how == 'max':
+            values = numpy.fmax.reduceat(self.values, starts, axis=0)
+        elif how == 'min':
+            values = numpy.fmin.reduceat(self.values, starts, axis=0)
+        else:
+            values = numpy.add.reduceat(numpy.where(valid, self.values, 0.0), starts, axis=0)
+            if how == 'average':
+                values /= numpy.maximum(counts, 1)
+        values[counts == 0] = numpy.nan
+        return self.__class__(self.targets, buckets[starts], values)
+
+    @classmethod
+    def concat(cls, frames, step=None):
+        """
+        Join the columns of frames on a common grid of `step` seconds (by
+        default the finest step of the frames), from the earliest timestamp
+        """
+        if numpy is None:
+            raise ImportError('numpy is required for GraphiteFrame')
+        frames = list(frames)
+        targets = [target for frame in frames for target in frame.targets]
+        filled = [frame for frame in frames if len(frame)]
+        if not filled:
+            return cls(targets, numpy.empty(0, dtype=numpy.int64),
+                       numpy.empty((0, len(targets)), dtype=numpy.float64))
+        if step is None and all(numpy.array_equal(frame.timestamps, filled[0].timestamps) for frame in frames):
+            return cls(targets, filled[0].timestamps, numpy.hstack([frame.values for frame in frames]))
+        if step is None:
+            steps = [int(numpy.diff(frame.timestamps).min()) for frame in filled if len(frame) > 1]
+            step = min(steps) if steps else 60
+        start = min(int(frame.timestamps[0]) for frame in filled)
+        end = max(int(frame.timestamps[-1]) for frame in filled)
+        timestamps = start + numpy.arange((end - start) // step + 1, dtype=numpy.int64) * step
+        values = numpy.full((len(timestamps), len(targets)), numpy.nan)
+        column = 0
+        for frame in frames:
+            rows = (frame.timestamps - start + step // 2) // step
+            values[rows, column:column + len(frame.targets)] = frame.values
+            column += len(frame.targets)
+        return cls(targets, timestamps, values)
+
+    def rate(self):
+        """
+        Per second increase of counters between consecutive points, NaN
+        where a counter went down (reset), like nonNegativeDerivative
+        """
+        if len(self.timestamps) < 2:
+            return self.__class__(self.targets, self.timestamps[:0], self.values[:0])
+        seconds = numpy.diff(self.timestamps).astype(numpy.float64)
+        values = numpy.diff(self.values, axis=0) / seconds[:, None]
+        values[values < 0] = numpy.nan
+        return self.__class__(self.targets, self.timestamps[1:], values)
+
+    def stats(self, how='average'):
+        """
+        One value per target over time, ignoring NaN (NaN for empty series)
+
+        :arg how: 'average', 'sum', 'min', 'max', 'last', or a percentile
+                  as 'p<percent>', e.g. 'p95'
+        :return: float64 array of len(targets)
+        """
+        return _graphite_reduce(self.values, how, 0)
+
+    def aggregate(self, how='sum', name=None):
+        """
+        Frame of one series combining all the targets at every timestamp,
+        like graphite sumSeries / averageSeries...
+
+        :arg how: see stats, except 'last'
+        """
+        name = name or '%s(%s)' % (how, ','.join(self.targets))
+        return self.__class__([name], self.timestamps, _graphite_reduce(self.values, how, 1)[:, None])
+
+    def group_by(self, node, how='sum'):
+        """
+        Frame of one series per distinct node (dot separated segment, from
+        0) of the target names, like graphite groupByNode, e.g.
+        group_by(1) of servers.*.iostat.*.iops gives the IOPS per server
+        """
+        groups = collections.OrderedDict()
+        for column, target in enumerate(self.targets):
+            groups.setdefault(target.split('.')[node], []).append(column)
+        values = numpy.empty((len(self.timestamps), len(groups)))
+        for i, columns in enumerate(groups.values()):
+            values[:, i] = _graphite_reduce(self.values[:, columns], how, 1)
+        return self.__class__(list(groups), self.timestamps, values)
+
+    def top(self, k=10, by='average'):
+        """
+        The k targets of highest stats(by), as [(target, value)] in
+        descending order; targets without data are left out
+        """
+        scores = self.stats(by)
+        candidates = numpy.flatnonzero(~numpy.isnan(scores))
+        if k < len(candidates):
+            candidates = candidates[numpy.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[numpy.argsort(-scores[candidates], kind='stable')]
+        return [(self.targets[i], float(scores[i])) for i in candidates]
+
+
+def _graphite_reduce(values, how, axis):
+    """
+    NaN ignoring reduction of a values matrix along axis (0: time, 1: targets)
+    """
+    valid = ~numpy.isnan(values)
+    counts = valid.sum(axis=axis)
+    if how == 'last' and axis != 0:
+        raise ValueError('last is only defined over time')
+    if values.shape[axis] == 0:
+        return numpy.full(counts.shape, numpy.nan)
+    if how == 'last':
+        rows = values.shape[0] - 1 - numpy.argmax(valid[::-1], axis=0)
+        result = values[rows, numpy.arange(values.shape[1])]
+    elif how.startswith('p'):
+        with warnings.catch_warnings():  # all-NaN slices
+            warnings.simplefilter('ignore', RuntimeWarning)
+            result = numpy.nanpercentile(values, float(how[1:]), axis=axis)
+    elif how in ('sum', 'average'):
+        result = numpy.where(valid, values, 0.0).sum(axis=axis)
+        if how == 'average':
+            result /= numpy.maximum(counts, 1)
+    elif how == 'max':
+        result = numpy.fmax.reduce(values, axis=axis)
+    elif how == 'min':
+        result = numpy.fmin.reduce(values, axis=axis)
+    else:
+        raise ValueError('Unknown aggregation %r' % (how, ))
+    result = numpy.array(result, dtype=numpy.float64, ndmin=1)
+    result[counts == 0] = numpy.nan
+    return result
+
+
+class GraphiteDeltaCache(object):
+    """
+    Most recent window of graph data per request, for incremental fetch
+
+    :arg overlap: seconds before the last cached point re-fetched every time,
+                  so that points still being aggregated are refreshed
+    :arg max_entries: max number of cached requests, least recently used
+                      ones are evicted first
+    """
+    def __init__(self, overlap=120, max_entries=1024):
+        self.overlap = overlap
+        self.max_entries = max_entries
+        self.full_fetches = 0
+        self.delta_fetches = 0
+        self._entries = collections.OrderedDict()  # key: (targets, rows)
+        self._lock = threading.Lock()
+
+    def since(self, key):
+        """
+        Timestamp to fetch key from, None if it is not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not entry[1]:
+                return None
+            return int(entry[1][-1][0]) - self.overlap
+
+    def merge(self, key, window, data, partial):
+        """
+        Merge freshly fetched data into the cached window of key
+
+        :arg window: seconds of data to keep, up to now
+        :arg partial: data was fetched from since(key) only
+        :return: the whole window, or None if partial data does not match
+                 the cached targets and a full fetch is needed
+        """
+        cutoff = time.time() - window
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if partial and (entry is None or entry[0] != data['targets']):
+                return None
+            if partial:
+                self.delta_fetches += 1
+                rows = entry[1]
+                new_rows = data['datapoints']
+                if new_rows:
+                    index = len(rows)
+                    while index and rows[index - 1][0] >= new_rows[0][0]:
+                        index -= 1
+                    del rows[index:]
+                    rows.extend(new_rows)
+            else:
+                self.full_fetches += 1
+                rows = list(data['datapoints'])
+            index = 0
+            while index < len(rows) and rows[index][0] <= cutoff:
+                index += 1
+            del rows[:index]
+            self._entries[key] = (list(data['targets']), rows)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return {'targets': list(data['targets']), 'datapoints': list(rows)}
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class GraphiteStore(object):
+    """
+    On-disk store of graph data shared by processes
+
+    One append-only file of fixed-width (int64 timestamp, float64 value)
+    records per target and resolution, memory-mapped for reading. When a
+    timestamp was written several times the last record wins. Writers and
+    compact() are serialized by a lock file, so a store directory can be
+    shared by many processes.
+
+    :arg directory: root of the store, created if needed
+    :arg retention: seconds of data kept by compact()
+    :arg overlap: seconds before the last stored point re-fetched every time,
+                  so that points still being aggregated are refreshed
+    """
+    record_size = 16
+
+    def __init__(self, directory, retention=8 * 86400, overlap=120):
+        if numpy is None:
+            raise ImportError('numpy is required for GraphiteStore')
+        self.directory = directory
+        self.retention = retention
+        self.overlap = overlap
+        self.dtype = numpy.dtype([('ts', '<i8'), ('value', '<f8')])
+        self._thread_lock = threading.RLock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.directory)
+
+    def path(self, target, resolution):
+        name = hashlib.sha1(target.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, str(resolution), name + '.dat')
+
+    def _lock(self, exclusive):
+        store = self
+
+        class Lock(object):
+            def __enter__(self):
+                store._thread_lock.acquire()
+                self.fd = None
+                if fcntl is not None:
+                    self.fd = os.open(os.path.join(store.directory, '.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+                    fcntl.flock(self.fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+            def __exit__(self, *exc_info):
+                if self.fd is not None:
+                    os.close(self.fd)  # releases the flock
+                store._thread_lock.release()
+        return Lock()
+
+    def last_timestamp(self, target, resolution):
+        """
+        Timestamp of the last record of target, None if nothing is stored
+        """
+        path = self.path(target, resolution)
+        with self._lock(exclusive=False):
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(0, os.SEEK_END)
+                    size = f.tell() - f.tell() % self.record_size
+                    if not size:
+                        return None
+                    f.seek(size - self.record_size)
+                    return int(numpy.frombuffer(f.read(self.record_size), dtype=self.dtype)['ts'][0])
+            except (IOError, OSError):
+                return None
+
+    def append(self, target, resolution, timestamps, values):
+        """
+        Append records of target, NaN values for gaps
+
+        Records already stored with the same timestamp and value are
+        skipped, so re-fetched windows do not grow the file.
+        """
+        if not len(timestamps):
+            return
+        records = numpy.empty(len(timestamps), dtype=self.dtype)
+        records['ts'] = timestamps
+        records['value'] = values
+        records = self._dedupe(records)
+        path = self.path(target, resolution)
+        with self._lock(exclusive=True):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            records = self._new_records(self._load(path), records)
+            if not len(records):
+                return
+            with open(path, 'ab') as f:
+                f.write(records.tobytes())
+
+    def _new_records(self, stored, records):
+        """
+        records whose timestamp is not stored, or stored with another value
+        """
+        stored = self._dedupe(stored)
+        if not len(stored):
+            return records
+        ts = stored['ts']
+        index = numpy.minimum(numpy.searchsorted(ts, records['ts']), len(ts) - 1)
+        old = stored['value'][index]
+        same = (ts[index] == records['ts']) & (
+            (old == records['value']) | (numpy.isnan(old) & numpy.isnan(records['value'])))
+        return records[~same]
+
+    def _load(self, path):
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                size -= size % self.record_size
+                if not size:
+                    return numpy.empty(0, dtype=self.dtype)
+                # the map outlives the file object, numpy keeps a reference to it
+                buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        except (IOError, OSError):
+            return numpy.empty(0, dtype=self.dtype)
+        return numpy.frombuffer(buf, dtype=self.dtype)
+
+    def _dedupe(self, records):
+        ts = records['ts']
+        if len(ts) < 2 or (ts[1:] > ts[:-1]).all():
+            return records
+        records = records[numpy.argsort(ts, kind='stable')]
+        ts = records['ts']
+        return records[numpy.append(ts[1:] != ts[:-1], True)]
+
+    def read(self, target, resolution, start=None, end=None):
+        """
+        (timestamps, values) arrays of target with start <= timestamp < end,
+        zero-copy views of the file unless duplicated records are resolved
+        """
+        with self._lock(exclusive=False):
+            records = self._load(self.path(target, resolution))
+        records = self._dedupe(records)
+        ts = records['ts']
+        lo = 0 if start is None else numpy.searchsorted(ts, start, side='left')
+        hi = len(ts) if end is None else numpy.searchsorted(ts, end, side='left')
+        return ts[lo:hi], records['value'][lo:hi]
+
+    def compact(self, now=None):
+        """
+        Rewrite every file without duplicated records and points older than retention
+        """
+        cutoff = (now if now is not None else time.time()) - self.retention
+        with self._lock(exclusive=True):
+            for resolution in os.listdir(self.directory):
+                subdir = os.path.join(self.directory, resolution)
+                if not os.path.isdir(subdir):
+                    continue
+                for name in os.listdir(subdir):
+                    if not name.endswith('.dat'):
+                        continue
+                    path = os.path.join(subdir, name)
+                    records = self._dedupe(self._load(path))
+                    records = records[records['ts'] >= cutoff]
+                    if not len(records):
+                        os.remove(path)
+                        continue
+                    tmp_path = path + '.tmp'
+                    with open(tmp_path, 'wb') as f:
+                        f.write(records.tobytes())
+                    os.rename(tmp_path, path)
+
+
+_delta_cache_lock = threading.Lock()
+
+
+class _MetricNode(object):
+    __slots__ = ('children', 'leaf')
+
+    def __init__(self, leaf=False):
+        self.children = {}
+        self.leaf = leaf
+
+
+_braces_re = re.compile(r'\{([^{}]*)\}')
+
+
+def _expand_braces(pattern):
+    """
+    'sd{a,b}*' -> ['sda*', 'sdb*'], as graphite globs do
+    """
+    match = _braces_re.search(pattern)
+    if not match:
+        return [pattern]
+    result = []
+    for alternative in match.group(1).split(','):
+        result.extend(_expand_braces(pattern[:match.start()] + alternative + pattern[match.end():]))
+    return result
+
+
+class MetricIndex(object):
+    """
+    In-memory prefix tree of the graphite metric namespace
+
+    Crawled once level by level (each level in parallel on the connection's
+    bulk thread pool), then refreshed incrementally: only the first
+    `refresh_depth` levels are listed again, new subtrees are crawled and
+    known deeper subtrees are kept. Glob queries (*, ?, [...], {a,b}) are
+    answered locally by find().
+
+    :arg connection: a blocking connection with the graphite mixin
+    :arg ttl: seconds between refreshes of the background thread, see start()
+    :arg path: optional JSON file the index is loaded from and saved to
+    """
+    def __init__(self, connection, ttl=300, refresh_depth=2, max_workers=None, path=None):
+        self.connection = connection
+        self.ttl = ttl
+        self.refresh_depth = refresh_depth
+        self.max_workers = max_workers
+        self.path = path
+        self.updated = None  # time.time() of the last crawl
+        self._root = None
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.connection)
+
+    @property
+    def ready(self):
+        return self._root is not None
+
+    @property
+    def stale(self):
+        return self.updated is None or time.time() - self.updated > self.ttl
+
+    def refresh(self, full=False):
+        """
+        Crawl the namespace, incrementally unless full or never crawled
+        """
+        with self._refresh_lock:
+            old_root = None if full else self._root
+            root = _MetricNode()
+            level = [('', root, old_root)]  # (metric id, new node, old node)
+            depth = 0
+            while level:
+                to_list = []
+                for metric_id, node, old_node in level:
+                    if old_node is not None and depth >= self.refresh_depth:
+                        node.children = old_node.children
+                    else:
+                        to_list.append((metric_id, node, old_node))
+                results = self.connection.map_concurrent(
+                    lambda metric_id: self.connection.graphite_metrics_find(
+                        metric_id + '.*' if metric_id else '*', use_index=False),
+                    [metric_id for metric_id, _, _ in to_list], max_workers=self.max_workers)
+                level = []
+                for (metric_id, node, old_node), result in zip(to_list, results):
+                    if result.error is not None:
+                        LOG.warning('Metric index crawl of %r failed: %s', metric_id, result.error)
+                        if old_node is not None:
+                            node.children = old_node.children
+                        continue
+                    for item in result.data:
+                        child = node.children[item['text']] = _MetricNode(leaf=bool(item.get('leaf')))
+                        if item.get('expandable', not child.leaf):
+                            old_child = old_node.children.get(item['text']) if old_node is not None else None
+                            level.append((item['id'], child, old_child))
+                depth += 1
+            self._root = root
+            self.updated = time.time()
+
+    def find(self, query):
+        """
+        Metrics matching a graphite glob, in the format of graphite_metrics_find
+        """
+        root = self._root
+        if root is None:
+            raise RuntimeError('Metric index is not crawled yet')
+        matches = [('', root)]
+        for part in query.split('.'):
+            patterns = _expand_braces(part)
+            found = collections.OrderedDict()
+            for metric_id, node in matches:
+                for pattern in patterns:
+                    if any(c in pattern for c in '*?['):
+                        names = [name for name in sorted(node.children)
+                                 if fnmatch.fnmatchcase(name, pattern)]
+                    else:
+                        names = [pattern] if pattern in node.children else []
+                    for name in names:
+                        child_id = metric_id + '.' + name if metric_id else name
+                        found.setdefault(child_id, node.children[name])
+            matches = list(found.items())
+        result = []
+        for metric_id, node in matches:
+            expandable = int(not node.leaf)
+            result.append({'id': metric_id, 'text': metric_id.rsplit('.', 1)[-1],
+                           'leaf': int(node.leaf), 'expandable': expandable,
+                           'allowChildren': expandable, 'context': {}})
+        return result
+
+    def save(self, path=None):
+        """
+        Save the index as JSON, atomically
+        """
+        def dump(node):
+            return [int(node.leaf), dict((name, dump(child)) for name, child in node.children.items())]
+        path = path or self.path
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'updated': self.updated, 'tree': dump(self._root)}, f, separators=(',', ':'))
+        os.rename(tmp_path, path)
+
+    def load(self, path=None):
+        def build(data):
+            node = _MetricNode(leaf=bool(data[0]))
+            node.children = dict((name, build(child)) for name, child in data[1].items())
+            return node
+        with open(path or self.path) as f:
+            data = json.load(f)
+        self._root = build(data['tree'])
+        self.updated = data['updated']
+
+    def start(self):
+        """
+        Refresh the index in a background thread every ttl seconds
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='calamari-metric-index')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while True:
+            wait = 0 if self.updated is None else max(0, self.updated + self.ttl - time.time())
+            if self._stop.wait(wait):
+                return
+            try:
+                self.refresh()
+                if self.path is not None:
+                    self.save()
+            except Exception:
+                LOG.exception('Metric index refresh failed')
+                if self._stop.wait(self.ttl):
+                    return
+
 
 class CalamariGraphiteMixin(object):
     """
     Graph data fetch methods from calamari frontend (romana)
-    """
 
-    def graphite_data_get(self, params):
+    Extra keyword arguments of the per-level helpers (iops_data,
+    server_cpu_data...) are passed to graphite_data_get, e.g.
+    iops_data(fsid, as_frame=True) returns a GraphiteFrame, and
+    server_cpu_data(fqdn, time_from='-7d', max_points=300) about 300 points
+    per series.
+    """
+    # conservative limit for proxies / web servers in front of calamari
+    graphite_max_url_length = 4000
+    # longest window served at 1min/point, see incremental in graphite_data_get
+    graphite_fine_window = 86400
+    graphite_delta_cache = None
+    # optional GraphiteStore consulted before the network
+    graphite_store = None
+    # optional MetricIndex answering graphite_metrics_find
+    graphite_metric_index = None
+
+    def graphite_data_get(self, params, fetch=True, as_frame=False, incremental=False,
+                          max_points=None, step=None, consolidate='average'):
         """
         Base method to fetch graph data
 
         :arg params: list of two-element tuples, not dict
+        :arg fetch: if False, return the params instead of sending the request
+        :arg as_frame: return a GraphiteFrame (numpy) instead of the json payload
+        :arg incremental: keep the window of a relative 'from' (e.g. '-1d') in
+                          graphite_delta_cache, and only fetch the points newer
+                          than the cached ones on the next calls. Windows over
+                          graphite_fine_window (15min/point) are always fully
+                          fetched
+        :arg max_points: let graphite consolidate the series to about this
+                         many points, see graphite_consolidate_params
+        :arg step: let graphite summarize the series to one point per step
+                   seconds
+        :arg consolidate: 'average', 'sum', 'min' or 'max'
+
+        With a graphite_store, requests with a relative 'from' are served from
+        the store, and only the points newer than the stored ones are fetched
+        (none if the store is up to date). Consolidated requests bypass the
+        store and the delta cache.
         """
+        if max_points is not None or step is not None:
+            params = self.graphite_consolidate_params(params, max_points, step, consolidate)
+        if not fetch:
+            return params
+        store_plan = self._graphite_store_plan(params)
+        if store_plan is not None:
+            data = None
+            if store_plan[-1] is not None:
+                data = self._graphite_render(store_plan[-1])
+            return self._graphite_store_commit(store_plan, data, as_frame)
+        plan = self._graphite_delta_plan(params) if incremental else None
+        if plan is not None and plan[2] is not None:
+            data = self._graphite_render(plan[2])
+            data = self.graphite_delta_cache.merge(plan[0], plan[1], data, partial=True)
+            if data is None:
+                data = self.graphite_delta_cache.merge(
+                    plan[0], plan[1], self._graphite_render(params), partial=False)
+        else:
+            data = self._graphite_render(params)
+            if plan is not None:
+                data = self.graphite_delta_cache.merge(plan[0], plan[1], data, partial=False)
+        if as_frame:
+            return GraphiteFrame.from_json(data)
+        return data
+
+    def _graphite_render(self, params):
+        params = list(params)
         params.append(('format', 'json-array'))
         data = self.get('/graphite/render/', params=params)
-        return data.json()   # {'targets': ['a', 'b'], 'datapoints': [[1453947000, 1, 2], ...]}
+        data = self._decode_json(data)   # {'targets': ['a', 'b'], 'datapoints': [[1453947000, 1, 2], ...]}
+        return self._graphite_consolidated(params, data)
+
+    @staticmethod
+    def graphite_consolidate_params(params, max_points=None, step=None, consolidate='average'):
+        """
+        Params asking graphite to send fewer points
+
+        With step, targets are wrapped in summarize(target, "<step>s", func,
+        true); with max_points, in consolidateBy(target, func) and
+        maxDataPoints is added. The response series keep the plain target
+        names, and are consolidated client side (numpy) if the server sent
+        more points than asked.
+        """
+        if consolidate not in _GRAPHITE_CONSOLIDATIONS:
+            raise ValueError('Unknown consolidation %r' % (consolidate, ))
+        result = []
+        for key, value in params:
+            if key == 'target':
+                if step is not None:
+                    value = 'summarize(%s,"%ds","%s",true)' % (
+                        value, step, _GRAPHITE_CONSOLIDATIONS[consolidate])
+                if max_points is not None:
+                    value = 'consolidateBy(%s,"%s")' % (value, consolidate)
+            elif key == 'maxDataPoints':
+                continue
+            result.append((key, value))
+        if max_points is not None:
+            result.append(('maxDataPoints', str(int(max_points))))
+        return result
+
+    @staticmethod
+    def _graphite_consolidation(params):
+        """
+        (max_points, step, consolidate) asked by consolidated params, None
+        if params are not consolidated
+        """
+        max_points = step = consolidate = None
+        for key, value in params:
+            if key == 'maxDataPoints':
+                max_points = int(value)
+            elif key == 'target' and step is None and consolidate is None:
+                match = _graphite_consolidate_by_re.match(value)
+                if match is not None:
+                    consolidate = match.group(2)
+                    value = match.group(1)
+                match = _graphite_summarize_re.match(value)
+                if match is not None:
+                    step = int(match.group(2))
+                    consolidate = dict((v, k) for k, v in _GRAPHITE_CONSOLIDATIONS.items())[match.group(3)]
+        if max_points is None and step is None:
+            return None
+        return max_points, step, consolidate or 'average'
+
+    def _graphite_consolidated(self, params, data):
+        """
+        Restore the plain target names of a consolidated response, and
+        consolidate it client side if the server did not
+        """
+        consolidation = self._graphite_consolidation(params)
+        if consolidation is None:
+            return data
+        targets = [graphite_unwrap_target(value) for key, value in params if key == 'target']
+        if len(data['targets']) == len(targets):
+            data['targets'] = targets
+        else:
+            data['targets'] = [graphite_unwrap_target(name) for name in data['targets']]
+        max_points, step, consolidate = consolidation
+        rows = data['datapoints']
+        if numpy is None or len(rows) < 2:
+            return data
+        if (max_points is not None and len(rows) > max_points) or (
+                step is not None and rows[1][0] - rows[0][0] < step):
+            frame = GraphiteFrame.from_json(data)
+            if step is not None:
+                frame = frame.downsample(step=step, how=consolidate)
+            if max_points is not None:
+                frame = frame.downsample(max_points=max_points, how=consolidate)
+            data = frame.to_json()
+        return data
 
-    def graphite_metrics_find(self, query):
+    def _graphite_store_plan(self, params):
+        """
+        (targets, resolution, window, lasts, params to fetch or None) of a
+        request served by graphite_store, None if it cannot be
+        """
+        if self.graphite_store is None or self._graphite_consolidation(params) is not None:
+            return None
+        targets, others, window = [], [], None
+        for key, value in params:
+            if key == 'target':
+                targets.append(value)
+            elif key == 'from':
+                window = graphite_time_offset(value)
+            elif key == 'until':
+                return None
+            else:
+                others.append((key, value))
+        if window is None or not targets:
+            return None
+        store = self.graphite_store
+        resolution = 60 if window <= self.graphite_fine_window else 900
+        lasts = [store.last_timestamp(target, resolution) for target in targets]
+        now = time.time()
+        if all(last is not None and last >= now - resolution for last in lasts):
+            return targets, resolution, window, lasts, None
+        fetch_params = list(params)
+        if resolution == 60 and all(last is not None and last > now - window for last in lasts):
+            fetch_params = [('target', target) for target in targets] + others
+            fetch_params.append(('from', str(min(lasts) - store.overlap)))
+        return targets, resolution, window, lasts, fetch_params
+
+    def _graphite_store_commit(self, plan, data, as_frame):
+        """
+        Write fetched data of a store plan, and read the whole window back
+        """
+        targets, resolution, window, lasts, _ = plan
+        store = self.graphite_store
+        if data is not None:
+            frame = GraphiteFrame.from_json(data)
+            if frame.targets != targets:  # series names changed, do not store them
+                return frame if as_frame else data
+            for i, target in enumerate(targets):
+                mask = Ellipsis
+                if lasts[i] is not None:
+                    mask = frame.timestamps > lasts[i] - store.overlap
+                store.append(target, resolution, frame.timestamps[mask], frame.values[mask, i])
+        start = time.time() - window
+        frame = GraphiteFrame.from_series(
+            targets, [store.read(target, resolution, start=start) for target in targets])
+        return frame if as_frame else frame.to_json()
+
+    def _graphite_delta_plan(self, params):
+        """
+        (key, window, delta params) of an incremental fetch, delta params
+        being None if key is not cached yet. None if params cannot be
+        fetched incrementally
+        """
+        if self._graphite_consolidation(params) is not None:
+            return None
+        window = None
+        others = []
+        for key, value in params:
+            if key == 'from':
+                window = graphite_time_offset(value)
+            elif key == 'until':
+                return None
+            else:
+                others.append((key, value))
+        if window is None or window > self.graphite_fine_window:
+            return None
+        if self.graphite_delta_cache is None:
+            with _delta_cache_lock:
+                if self.graphite_delta_cache is None:
+                    self.graphite_delta_cache = GraphiteDeltaCache()
+        # windows of the same targets are cached apart, one would trim the other
+        key = (window, tuple(others))
+        since = self.graphite_delta_cache.since(key)
+        if since is None or since < time.time() - window:
+            # not cached, or so stale that the delta would be the whole window
+            return key, window, None
+        return key, window, others + [('from', str(since))]
+
+    def graphite_metrics_find(self, query, use_index=True):
         """
         Search for specific metrics (CPU/disk/NIC names of a server)
+
+        :arg use_index: answer from graphite_metric_index when it is crawled
         """
+        index = self.graphite_metric_index
+        if use_index and index is not None and index.ready:
+            return index.find(query)
+        generation = self.auth_generation
         data = self.get('/graphite/metrics/find', params={'query': query})
         try:
-            data = data.json()
+            data = self._decode_json(data)
         except: # if data format error, need re-auth
-            self.authenticate()
+            self.reauthenticate(generation)
             data = self.get('/graphite/metrics/find', params={'query': query})
-            data = data.json()
+            data = self._decode_json(data)
         return data
 
-    def iops_data(self, cluster_id, pool_id='all', time_from='-1d'):
+    def graphite_batch_get(self, calls, max_url_length=None, max_workers=None, **kwargs):
+        """
+        Fetch the graph data of many helper calls in as few render requests as possible
+
+        Targets of the calls sharing the same other params (time_from...) are
+        packed into requests whose URL stays under max_url_length, the
+        requests are sent on the bulk thread pool, and the response columns
+        are split back per call by series name (a glob target gets every
+        series it matches).
+
+        :arg calls: list of (helper, args) pairs, helper is the name of a
+                    helper of this mixin (e.g. 'server_cpu_data'), args an
+                    entity (e.g. a fqdn) or a tuple of positional arguments
+        :arg kwargs: passed to every helper, e.g. time_from='-3d'
+        :return: list of BulkResult in calls order, whose data is the
+                 {'targets', 'datapoints'} (or GraphiteFrame with as_frame=True)
+                 of that call alone
+        """
+        as_frame = kwargs.pop('as_frame', False)
+        calls = list(calls)
+        helper_params = [getattr(self, helper)(*args, fetch=False, **kwargs)
+                         for helper, args in self._graphite_batch_calls(calls)]
+        batches = self._graphite_batch_plan(helper_params, max_url_length)
+
+        def fetch_batch(batch):
+            return self.graphite_data_get(params=self._graphite_batch_params(batch), as_frame=as_frame)
+
+        return self._graphite_batch_results(
+            calls, [(result.key, result.data, result.error)
+                    for result in self.map_concurrent(fetch_batch, batches, max_workers=max_workers)])
+
+    @staticmethod
+    def _graphite_batch_calls(calls):
+        for helper, args in calls:
+            yield helper, args if isinstance(args, tuple) else (args, )
+
+    def _graphite_batch_plan(self, helper_params, max_url_length=None):
+        """
+        Pack the params of the calls into batches (others, [(index, targets)],
+        {target: column}) whose render URL stays under max_url_length
+        """
+        max_url_length = max_url_length or self.graphite_max_url_length
+        groups = collections.OrderedDict()  # other params: [(index, targets)]
+        for index, params in enumerate(helper_params):
+            targets = [value for key, value in params if key == 'target']
+            others = tuple(param for param in params if param[0] != 'target')
+            groups.setdefault(others, []).append((index, targets))
+
+        batches = []
+        base_length = len('%s/graphite/render/?format=json-array' % (self.host, ))
+        for others, items in groups.items():
+            empty_length = base_length + len(urlencode(others)) + 1
+            batch, columns, length = [], collections.OrderedDict(), empty_length
+            for index, targets in items:
+                new_targets = [t for t in targets if t not in columns]
+                item_length = sum(len(urlencode([('target', t)])) + 1 for t in new_targets)
+                if batch and length + item_length > max_url_length:
+                    batches.append((others, batch, columns))
+                    batch, columns, length = [], collections.OrderedDict(), empty_length
+                    new_targets = targets
+                    item_length = sum(len(urlencode([('target', t)])) + 1 for t in targets)
+                for target in new_targets:
+                    columns.setdefault(target, len(columns))
+                batch.append((index, targets))
+                length += item_length
+            if batch:
+                batches.append((others, batch, columns))
+        return batches
+
+    @staticmethod
+    def _graphite_batch_params(batch):
+        others, _, columns = batch
+        return [('target', target) for target in columns] + list(others)
+
+    def _graphite_batch_results(self, calls, fetched):
+        """
+        BulkResult per call out of the (batch, data, error) of every batch
+        """
+        results = [None] * len(calls)
+        for batch, batch_data, batch_error in fetched:
+            _, items, columns = batch
+            for index, targets in items:
+                data, error = None, batch_error
+                if error is None:
+                    try:
+                        data = self._graphite_split(batch_data, columns, targets)
+                    except ValueError as e:
+                        error = e
+                results[index] = BulkResult(calls[index], data, error)
+        return results
+
+    @staticmethod
+    def _graphite_split(data, columns, targets):
+        """
+        Columns of data answering targets, matched by series name: a glob
+        target gets every series it matches, in response order
+        """
+        if isinstance(data, GraphiteFrame):
+            names = data.targets
+        else:
+            names = data['targets']
+        positions = dict((name, i) for i, name in enumerate(names))
+        indexes, missing = [], []
+        for target in targets:
+            plain = graphite_unwrap_target(target)
+            if plain in positions:
+                indexes.append(positions[plain])
+            elif target in positions:
+                indexes.append(positions[target])
+            elif any(c in plain for c in '*?[{'):
+                patterns = _expand_braces(plain)
+                indexes.extend(i for i, name in enumerate(names)
+                               if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns))
+            else:
+                missing.append(target)
+        if missing:
+            globs = any(any(c in target for c in '*?[{') for target in columns)
+            if globs or len(names) != len(columns):
+                raise ValueError('Cannot split graphite series %r out of %r' % (missing, names))
+            # the server renamed the series, one column per target in request order
+            indexes = [columns[target] for target in targets]
+        if isinstance(data, GraphiteFrame):
+            return GraphiteFrame([names[i] for i in indexes], data.timestamps, data.values[:, indexes])
+        return {
+            'targets': [names[i] for i in indexes],
+            'datapoints': [[row[0]] + [row[i + 1] for i in indexes] for row in data['datapoints']],
+        }
+
+    def graphite_fleet_get(self, pattern, time_from='-1d', max_url_length=None, max_workers=None, **kwargs):
+        """
+        Graph data of every metric matching a pattern, in one GraphiteFrame
+
+        The pattern is expanded with graphite_metrics_find (or the
+        graphite_metric_index), the metrics are fetched in as few render
+        requests as the URL length allows, in parallel, and the columns are
+        aligned on a common timestamp grid (GraphiteFrame.concat), ready for
+        rate / stats / aggregate / group_by / top.
+
+        :arg pattern: graphite glob of leaf metrics, e.g.
+                      'servers.*.iostat.*.iops' or 'servers.*.network.eth*.rx_byte'
+        :arg kwargs: passed to graphite_data_get, e.g. max_points=300
+        """
+        batches = self._graphite_fleet_batches(self.graphite_metrics_find(pattern), time_from, max_url_length)
+        frames = []
+        for result in self.map_concurrent(
+                lambda params: self.graphite_data_get(params, as_frame=True, **kwargs), batches,
+                max_workers=max_workers):
+            if result.error is not None:
+                raise result.error
+            frames.append(result.data)
+        return GraphiteFrame.concat(frames)
+
+    def graphite_fleet_top(self, pattern, k=10, by='average', rate=False, time_from='-1d', **kwargs):
+        """
+        The k metrics matching a pattern with the highest stats(by), e.g.
+        the 10 disks of highest p95 IOPS over the last day:
+
+            graphite_fleet_top('servers.*.iostat.*.iops', by='p95')
+
+        :arg rate: rank the per second rate of counters instead of their values
+        :return: [(metric, value)] in descending order
+        """
+        frame = self.graphite_fleet_get(pattern, time_from=time_from, **kwargs)
+        if rate:
+            frame = frame.rate()
+        return frame.top(k, by)
+
+    def _graphite_fleet_batches(self, metrics, time_from, max_url_length=None):
+        """
+        Render params of the leaf metrics, packed under max_url_length
+        """
+        if numpy is None:
+            raise ImportError('numpy is required for fleet graph data')
+        max_url_length = max_url_length or self.graphite_max_url_length
+        others = [('from', time_from)]
+        empty_length = len('%s/graphite/render/?format=json-array' % (self.host, )) + len(urlencode(others)) + 1
+        batches, batch, length = [], [], empty_length
+        for metric in metrics:
+            if not int(metric.get('leaf', 1)):
+                continue
+            target = ('target', metric['id'])
+            item_length = len(urlencode([target])) + 1
+            if batch and length + item_length > max_url_length:
+                batches.append(batch + others)
+                batch, length = [], empty_length
+            batch.append(target)
+            length += item_length
+        if batch:
+            batches.append(batch + others)
+        return batches
+
+    def iops_data(self, cluster_id, pool_id='all', time_from='-1d', **kwargs):
         """
         IOPS of a pool / pools aggretate [Cluster-Level]
 
@@ -51,9 +1232,9 @@ class CalamariGraphiteMixin(object):
         params.append(('target', 'ceph.cluster.%s.pool.%s.num_read' % (cluster_id, pool_id)))
         params.append(('target', 'ceph.cluster.%s.pool.%s.num_write' % (cluster_id, pool_id)))
         params.append(('from', time_from))
-        return self.graphite_data_get(params=params)
+        return self.graphite_data_get(params=params, **kwargs)
 
-    def disk_usage_data(self, cluster_id, time_from='-1d'):
+    def disk_usage_data(self, cluster_id, time_from='-1d', **kwargs):
         """
         Disk usage of all pools total [Cluster-Level]
 
@@ -63,57 +1244,63 @@ class CalamariGraphiteMixin(object):
         params.append(('target', 'sumSeries(scale(ceph.cluster.%s.df.total_avail,1024), ceph.cluster.%s.df.total_avail_bytes)' % (cluster_id, cluster_id)))
         params.append(('target', 'sumSeries(scale(ceph.cluster.%s.df.total_used,1024), ceph.cluster.%s.df.total_used_bytes)' % (cluster_id, cluster_id)))
         params.append(('from', time_from))
-        return self.graphite_data_get(params=params)
+        return self.graphite_data_get(params=params, **kwargs)
 
-    def server_cpu_data(self, fqdn, time_from='-1d'):
+    def server_cpu_data(self, fqdn, time_from='-1d', **kwargs):
         """
         CPU usage summary of a server [Server-Level]
 
-        :arg fdqdn: Fully qualified domain name of a server from v2 api
+        :arg fdqdn: Fully qualified domain name of a server from v2 api,
+                    its graphite path is graphite_host(fqdn)
         :arg time_from: -1hour / -12hour / -1d / -3d / -7d
         """
+        host = graphite_host(fqdn)
         params = []
-        params.append(('target', 'servers.%s.cpu.total.system' % (fqdn, )))
-        params.append(('target', 'servers.%s.cpu.total.user' % (fqdn, )))
-        params.append(('target', 'servers.%s.cpu.total.idle' % (fqdn, )))
+        params.append(('target', 'servers.%s.cpu.total.system' % (host, )))
+        params.append(('target', 'servers.%s.cpu.total.user' % (host, )))
+        params.append(('target', 'servers.%s.cpu.total.idle' % (host, )))
         params.append(('from', time_from))
-        return self.graphite_data_get(params=params)
+        return self.graphite_data_get(params=params, **kwargs)
 
-    def server_loadavg_data(self, fqdn, time_from='-1d'):
+    def server_loadavg_data(self, fqdn, time_from='-1d', **kwargs):
         """
         Load average summary of a server [Server-Level]
 
-        :arg fdqdn: Fully qualified domain name of a server from v2 api
+        :arg fdqdn: Fully qualified domain name of a server from v2 api,
+                    its graphite path is graphite_host(fqdn)
         :arg time_from: -1hour / -12hour / -1d / -3d / -7d
         """
+        host = graphite_host(fqdn)
         params = []
-        params.append(('target', 'servers.%s.loadavg.01' % (fqdn, )))
-        params.append(('target', 'servers.%s.loadavg.05' % (fqdn, )))
-        params.append(('target', 'servers.%s.loadavg.15' % (fqdn, )))
+        params.append(('target', 'servers.%s.loadavg.01' % (host, )))
+        params.append(('target', 'servers.%s.loadavg.05' % (host, )))
+        params.append(('target', 'servers.%s.loadavg.15' % (host, )))
         params.append(('from', time_from))
-        return self.graphite_data_get(params=params)
+        return self.graphite_data_get(params=params, **kwargs)
 
-    def server_memory_data(self, fqdn, time_from='-1d'):
+    def server_memory_data(self, fqdn, time_from='-1d', **kwargs):
         """
         Memory usage summary of a server [Server-Level]
 
-        :arg fdqdn: Fully qualified domain name of a server from v2 api
+        :arg fdqdn: Fully qualified domain name of a server from v2 api,
+                    its graphite path is graphite_host(fqdn)
         :arg time_from: -1hour / -12hour / -1d / -3d / -7d
         """
+        host = graphite_host(fqdn)
         params = []
-        params.append(('target', 'servers.%s.memory.Active' % (fqdn, )))
-        params.append(('target', 'servers.%s.memory.Buffers' % (fqdn, )))
-        params.append(('target', 'servers.%s.memory.Cached' % (fqdn, )))
-        params.append(('target', 'servers.%s.memory.MemFree' % (fqdn, )))
+        params.append(('target', 'servers.%s.memory.Active' % (host, )))
+        params.append(('target', 'servers.%s.memory.Buffers' % (host, )))
+        params.append(('target', 'servers.%s.memory.Cached' % (host, )))
+        params.append(('target', 'servers.%s.memory.MemFree' % (host, )))
         params.append(('from', time_from))
-        return self.graphite_data_get(params=params)
+        return self.graphite_data_get(params=params, **kwargs)
 
-    def server_cpu_detail_data(self, server_cpu_id, time_from='-1d'):
+    def server_cpu_detail_data(self, server_cpu_id, time_from='-1d', **kwargs):
         """
         Detailed usage of a CPU [CPU-Level]
 
         :arg server_cpu_id: id in [x['id'] for x in 
-            self.graphite_metrics_find('servers.%s.cpu.*' % fqdn)]
+            self.graphite_metrics_find('servers.%s.cpu.*' % graphite_host(fqdn))]
         :arg time_from: -1hour / -12hour / -1d / -3d / -7d
         """
         # 注：上面拿到的列表里包括一个特例叫total
@@ -127,14 +1314,14 @@ class CalamariGraphiteMixin(object):
         params.append(('target', '%s.softirq' % (server_cpu_id, )))
         params.append(('target', '%s.steal' % (server_cpu_id, )))
         params.append(('from', time_from))
-        return self.graphite_data_get(params=params)
+        return self.graphite_data_get(params=params, **kwargs)
 
-    def server_disk_detail_data(self, server_disk_id, time_from='-1d'):
+    def server_disk_detail_data(self, server_disk_id, time_from='-1d', **kwargs):
         """
         Detailed usage of a disk [Disk-Level]
 
         :arg server_cpu_id: id in [x['id'] for x in 
-            self.graphite_metrics_find('servers.%s.iostat.*' % fqdn)]
+            self.graphite_metrics_find('servers.%s.iostat.*' % graphite_host(fqdn))]
         :arg time_from: -1hour / -12hour / -1d / -3d / -7d
         """
         # 注：上面拿到的列表里磁盘和分区都会有，比如一块盘的话会有一个vda和一个vda1
@@ -148,14 +1335,14 @@ class CalamariGraphiteMixin(object):
         # iops
         params.append(('target', '%s.iops' % (server_disk_id, )))
         params.append(('from', time_from))
-        return self.graphite_data_get(params=params)
+        return self.graphite_data_get(params=params, **kwargs)
 
-    def server_network_detail_data(self, server_nic_id, time_from='-1d'):
+    def server_network_detail_data(self, server_nic_id, time_from='-1d', **kwargs):
         """
         Detailed usage of a NIC [NIC-Level]
 
         :arg server_nic_id: id in [x['id'] for x in 
-            self.graphite_metrics_find('servers.%s.network.*' % fqdn)]
+            self.graphite_metrics_find('servers.%s.network.*' % graphite_host(fqdn))]
         :arg time_from: -1hour / -12hour / -1d / -3d / -7d
         """
         params = []
@@ -170,19 +1357,1578 @@ class CalamariGraphiteMixin(object):
         params.append(('target', '%s.tx_drops' % (server_nic_id, )))
         params.append(('target', '%s.rx_drops' % (server_nic_id, )))
         params.append(('from', time_from))
-        return self.graphite_data_get(params=params)
+        return self.graphite_data_get(params=params, **kwargs)
+
+
+class AIMDLimiter(object):
+    """
+    Adaptive limit of the requests in flight through a connection (AIMD)
+
+    Every successful request raises the limit by increase / limit, about
+    `increase` per round trip of a full window; an overloaded response
+    (429, 5xx) or a connection error / timeout multiplies it by `decrease`.
+    The failures of the requests sent before the last decrease are ignored,
+    so that one overloaded window decreases the limit once. Requests over
+    the limit wait for a slot.
+    """
+    def __init__(self, initial=4, min_limit=1, max_limit=64, increase=1.0, decrease=0.5):
+        self.initial = initial
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.limit = float(initial)
+        self.inflight = 0
+        self.waits = 0
+        self.decreases = 0
+        self._last_decrease = None
+        self._cond = threading.Condition()
+
+    def __repr__(self):
+        return '<%s: limit %.1f, %d in flight>' % (self.__class__.__name__, self.limit, self.inflight)
+
+    def copy(self):
+        """
+        New limiter with the same settings, e.g. for another host
+        """
+        return self.__class__(self.initial, self.min_limit, self.max_limit, self.increase, self.decrease)
+
+    def acquire(self):
+        """
+        Wait for a slot, return the start time to pass to release()
+        """
+        with self._cond:
+            if self.inflight >= int(self.limit):
+                self.waits += 1
+                while self.inflight >= int(self.limit):
+                    self._cond.wait()
+            self.inflight += 1
+            return _now()
+
+    def release(self, started, overloaded=False):
+        with self._cond:
+            self.inflight -= 1
+            if not overloaded:
+                self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+            elif self._last_decrease is None or started >= self._last_decrease:
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                self._last_decrease = _now()
+                self.decreases += 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {'limit': self.limit, 'inflight': self.inflight, 'waits': self.waits,
+                    'decreases': self.decreases}
+
+
+class TokenBucket(object):
+    """
+    `rate` requests per second on average, bursts of up to `burst`
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self.tokens = self.capacity
+        self._last = _now()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available, return the seconds waited
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = _now()
+                self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class RateLimits(object):
+    """
+    Per endpoint token buckets
+
+    Endpoints are URL templates (see Instrumentation.url_template), e.g.
+    /api/v2/cluster/{fsid}/osd/{id}; each endpoint matching a pattern
+    gets its own bucket.
+
+    :arg limits: list of (fnmatch pattern, requests per second, burst),
+                 e.g. [('/graphite/render/', 5, 10), ('/api/v2/*', 50, 100)];
+                 the first matching one wins
+    """
+    def __init__(self, limits):
+        self.limits = [(re.compile(fnmatch.translate(pattern)), rate, burst)
+                       for pattern, rate, burst in limits]
+        self.waited = 0.0
+        self._buckets = {}  # endpoint: TokenBucket or None
+        self._lock = threading.Lock()
+
+    def bucket(self, url):
+        endpoint = Instrumentation.url_template(url)
+        with self._lock:
+            if endpoint not in self._buckets:
+                bucket = None
+                for pattern, rate, burst in self.limits:
+                    if pattern.match(endpoint):
+                        bucket = TokenBucket(rate, burst)
+                        break
+                self._buckets[endpoint] = bucket
+            return self._buckets[endpoint]
+
+    def acquire(self, url):
+        bucket = self.bucket(url)
+        if bucket is not None:
+            waited = bucket.acquire()
+            if waited:
+                with self._lock:
+                    self.waited += waited
+
+
+class RetryPolicy(object):
+    """
+    Retries of idempotent requests (GETs) with jittered exponential backoff
+
+    A response with one of `statuses`, a connection error or a timeout is
+    retried up to `retries` times, after a random delay between 0 and
+    backoff * 2 ** attempt (at most max_backoff), or after the server's
+    Retry-After.
+    """
+    statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, retries=3, backoff=0.2, max_backoff=10, statuses=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        if statuses is not None:
+            self.statuses = tuple(statuses)
+
+    def should_retry(self, response):
+        return response.status_code in self.statuses
+
+    def delay(self, attempt, response=None):
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                return min(self.max_backoff, int(retry_after))
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class ResponseCache(object):
+    """
+    Size bounded LRU cache of decoded api_get responses
+
+    Only urls matching one of the `ttls` patterns are cached. Concurrent
+    requests of the same url + params share one HTTP request (single-flight).
+    Cached data is shared between callers, do not modify it in place.
+    Entries are keyed by namespace too (the API base URL of a connection),
+    so one cache can be shared by v1 and v2 connections. Loads in flight
+    when invalidate() is called are not stored.
+
+    :arg ttls: list of (pattern, seconds), fnmatch patterns on the api url
+               (e.g. '/cluster/*/crush_map'), the first matching one wins.
+               Defaults to DEFAULT_TTLS
+    :arg max_entries: max number of cached responses, least recently used
+                      ones are evicted first
+    """
+    DEFAULT_TTLS = [
+        ('/info', 300),
+        ('/key', 60),
+        ('/cluster/*/config', 300),
+        ('/cluster/*/crush_map', 60),
+        ('/cluster/*/crush_type', 300),
+        ('/server/*/grains', 300),
+    ]
+
+    def __init__(self, ttls=None, max_entries=1024):
+        self.ttls = [(re.compile(fnmatch.translate(pattern)), ttl)
+                     for pattern, ttl in (ttls if ttls is not None else self.DEFAULT_TTLS)]
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()  # key: (expires, data)
+        self._inflight = {}  # key: [threading.Event, data, error]
+        self._generation = 0  # bumped by invalidate()
+        self._lock = threading.Lock()
+
+    def get_ttl(self, url):
+        url = '/' + url.lstrip('/')
+        for pattern, ttl in self.ttls:
+            if pattern.match(url):
+                return ttl
+        return None
+
+    @staticmethod
+    def make_key(url, params=None, namespace=None):
+        url = '/' + url.lstrip('/')
+        if isinstance(params, dict):
+            params = params.items()
+        return (namespace, url, tuple(sorted(params or ())))
+
+    def get_or_load(self, url, params, loader, namespace=None):
+        """
+        Return the cached response of url + params, or load() and cache it
+
+        :arg namespace: e.g. the API base URL, responses of different
+                        namespaces are cached apart
+        """
+        ttl = self.get_ttl(url)
+        if ttl is None:
+            return loader()
+        key = self.make_key(url, params, namespace)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > _now():
+                self._entries[key] = self._entries.pop(key)  # most recently used
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = [threading.Event(), None, None]
+                generation = self._generation
+        if not leader:
+            flight[0].wait()
+            if flight[2] is not None:
+                raise flight[2]
+            return flight[1]
+        try:
+            flight[1] = data = loader()
+        except Exception as e:
+            flight[2] = e
+            raise
+        else:
+            self._store(key, data, ttl, generation)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight[0].set()
+        return data
+
+    def _store(self, key, data, ttl, generation):
+        with self._lock:
+            if generation != self._generation:  # invalidated while loading
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (_now() + ttl, data)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, prefix=None):
+        """
+        Drop cached responses whose url starts with prefix, or all of them
+        """
+        with self._lock:
+            self._generation += 1
+            if prefix is None:
+                self._entries.clear()
+                return
+            prefix = '/' + prefix.lstrip('/')
+            for key in [key for key in self._entries if key[1].startswith(prefix)]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'size': len(self._entries)}
+
+
+class RequestWaiter(object):
+    """
+    Wait for many asynchronous calamari requests (pool/OSD updates, cli...)
+
+    All tracked request ids are checked with one request_list(state=
+    'submitted') (or cluster_request_list(fsid, ...)) call per poll, all its
+    pages if paginated, instead of one GET per id: tracked ids missing from
+    it are complete, and only those are fetched with request_get()
+    (cluster_request_get()), once each.
+    The poll interval starts at `interval`, grows by `backoff` while nothing
+    completes, up to `max_interval`, and is reset when a request completes
+    or a new one is tracked.
+
+    Polling happens in the thread calling wait(), or in a background thread
+    after start().
+    """
+    def __init__(self, connection, fsid=None, interval=0.5, max_interval=10, backoff=1.5):
+        self.connection = connection
+        self.fsid = fsid
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.polls = 0
+        self._current_interval = interval
+        self._pending = {}  # request id: (future, deadline)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, request_id, callback=None, timeout=None):
+        """
+        Track a request id
+
+        :arg callback: called with the completed request
+        :arg timeout: seconds after which the future fails with a TimeoutError
+        :return: Future resolved with the completed request (check its
+                 'error' / 'error_message')
+        """
+        with self._lock:
+            entry = self._pending.get(request_id)
+            if entry is None:
+                deadline = _now() + timeout if timeout is not None else None
+                entry = self._pending[request_id] = (Future(), deadline)
+            self._current_interval = self.interval
+        if callback is not None:
+            entry[0].add_done_callback(
+                lambda future: future.exception() is None and callback(future.result()))
+        self._wakeup.set()
+        return entry[0]
+
+    def _list_complete(self, request_ids):
+        """
+        {request id: request} of the completed ones among request_ids
+        """
+        submitted = set()
+        page = None
+        while True:
+            if self.fsid is not None:
+                requests_ = self.connection.cluster_request_list(self.fsid, state='submitted', page=page)
+            else:
+                requests_ = self.connection.request_list(state='submitted', page=page)
+            if not isinstance(requests_, dict):  # not paginated
+                submitted.update(request['id'] for request in requests_)
+                break
+            submitted.update(request['id'] for request in requests_.get('results', []))
+            if not requests_.get('next'):
+                break
+            page = (page or 1) + 1
+        done = [request_id for request_id in request_ids if request_id not in submitted]
+        if self.fsid is not None:
+            get = lambda request_id: self.connection.cluster_request_get(self.fsid, request_id)
+        else:
+            get = self.connection.request_get
+        complete = {}
+        for result in self.connection.map_concurrent(get, done):
+            if result.error is not None:
+                LOG.warning('Calamari request %s check failed: %s', result.key, result.error)
+            elif result.data.get('state') == 'complete':
+                complete[result.key] = result.data
+        return complete
+
+    def poll(self):
+        """
+        Check the tracked requests once, return the number of completed ones
+        """
+        with self._lock:
+            if not self._pending:
+                return 0
+            request_ids = list(self._pending)
+        self.polls += 1
+        complete = self._list_complete(request_ids)
+        now = _now()
+        done = []
+        with self._lock:
+            for request_id, (future, deadline) in list(self._pending.items()):
+                if request_id in complete:
+                    done.append((future, complete[request_id], None))
+                elif deadline is not None and now > deadline:
+                    done.append((future, None, FutureTimeoutError(
+                        'Calamari request %s is not complete' % (request_id, ))))
+                else:
+                    continue
+                del self._pending[request_id]
+            if done:
+                self._current_interval = self.interval
+            else:
+                self._current_interval = min(self._current_interval * self.backoff, self.max_interval)
+        for future, request, error in done:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(request)
+        return len(done)
+
+    def wait(self, request_ids, timeout=600):
+        """
+        Block until all request_ids are complete, return their requests in order
+
+        :arg timeout: seconds after which a request still not complete raises
+                      a TimeoutError, None to wait forever
+        """
+        futures = [self.add(request_id, timeout=timeout) for request_id in request_ids]
+        if self._thread is not None and self._thread.is_alive():
+            for future in futures:
+                future.exception()  # blocks until resolved by the background thread
+        while not all(future.done() for future in futures):
+            self.poll()
+            if not all(future.done() for future in futures):
+                time.sleep(self._current_interval)
+        return [future.result() for future in futures]
+
+    def start(self):
+        """
+        Poll in a background thread until stop()
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='calamari-request-waiter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception:
+                LOG.exception('Calamari request poll failed')
+            with self._lock:
+                idle = not self._pending
+            self._wakeup.clear()
+            self._wakeup.wait(None if idle else self._current_interval)
+
+
+def parse_crush_text(text):
+    """
+    Decompiled (crushtool -d) CRUSH map text, in the json layout of
+    'ceph osd crush dump' (weights in 16.16 fixed point)
+    """
+    devices, types, buckets, rules = [], [], [], []
+    block = kind = None
+    for line in text.splitlines():
+        words = line.split('#', 1)[0].split()
+        if not words:
+            continue
+        if block is None:
+            if words[0] == 'device' and len(words) >= 3:
+                devices.append({'id': int(words[1]), 'name': words[2]})
+            elif words[0] == 'type' and len(words) >= 3:
+                types.append({'type_id': int(words[1]), 'name': words[2]})
+            elif len(words) == 3 and words[2] == '{':
+                kind = words[0]
+                if kind == 'rule':
+                    block = {'rule_name': words[1], 'steps': []}
+                else:
+                    block = {'name': words[1], 'type_name': kind, 'items': []}
+            continue  # tunables
+        if words[0] == '}':
+            (rules if kind == 'rule' else buckets).append(block)
+            block = None
+        elif kind == 'rule':
+            if words[0] == 'step' and words[1] == 'take':
+                block['steps'].append({'op': 'take', 'item_name': words[2]})
+            elif words[0] == 'step' and words[1] == 'emit':
+                block['steps'].append({'op': 'emit'})
+            elif words[0] == 'step' and len(words) >= 6:  # step chooseleaf firstn 0 type host
+                block['steps'].append({'op': '%s_%s' % (words[1], words[2]), 'num': int(words[3]),
+                                       'type': words[5]})
+            elif words[0] in ('id', 'ruleset', 'min_size', 'max_size'):
+                block['rule_id' if words[0] == 'id' else words[0]] = int(words[1])
+            elif words[0] == 'type':
+                block['type'] = words[1]
+        elif words[0] == 'id' and len(words) == 2:  # 'id -5 class ssd' is a shadow tree id
+            block['id'] = int(words[1])
+        elif words[0] == 'item':
+            weight = float(words[words.index('weight') + 1]) if 'weight' in words else 0.0
+            block['items'].append({'name': words[1], 'weight': int(round(weight * 0x10000))})
+        elif words[0] in ('alg', 'hash'):
+            block[words[0]] = words[1]
+    ids = dict((item['name'], item['id']) for item in devices + buckets)
+    for bucket in buckets:
+        for item in bucket['items']:
+            item['id'] = ids[item.pop('name')]
+    for rule in rules:
+        rule.setdefault('rule_id', rule.get('ruleset'))
+        for step in rule['steps']:
+            if step['op'] == 'take':
+                step['item'] = ids.get(step['item_name'])
+    return {'devices': devices, 'types': types, 'buckets': buckets, 'rules': rules}
+
+
+class CrushTopology(object):
+    """
+    Indexed CRUSH hierarchy of a cluster, built once per map
+
+    Every lookup is then a dict lookup. Items are CRUSH ids: OSD ids (>= 0)
+    and bucket ids (< 0); weights are CRUSH weights (1.0 ~ 1 TiB).
+    Device class shadow trees (e.g. default~ssd) are left out.
+
+    :arg crush_map: 'ceph osd crush dump' json (cluster_crush_map, or the
+                    'crush' of the osd_map sync object), or the decompiled text
+    :arg version: osd_map version the map comes from
+
+    :attr names: {id: name}, and ids {name: id}
+    :attr type_of: {id: type name}, 'osd' for devices
+    :attr parent: {id: parent bucket id}, roots have none
+    :attr children: {bucket id: tuple of item ids}
+    :attr weight: {id: weight of the subtree}
+    :attr osds_under: {id: frozenset of the OSD ids of the subtree}
+    :attr rules: {rule id: rule}
+    """
+    def __init__(self, crush_map, version=None):
+        if not isinstance(crush_map, dict):
+            crush_map = parse_crush_text(crush_map)
+        self.version = version
+        type_names = dict((t.get('type_id', t.get('id')), t['name']) for t in crush_map.get('types', ()))
+        osd_type = type_names.get(0, 'osd')
+        self.names, self.type_of, self.parent, self.children = {}, {}, {}, {}
+        item_weights = {}
+        for device in crush_map.get('devices', ()):
+            self.names[device['id']] = device['name']
+            self.type_of[device['id']] = osd_type
+        for bucket in crush_map.get('buckets', ()):
+            if '~' in bucket['name']:
+                continue
+            bucket_id = bucket['id']
+            self.names[bucket_id] = bucket['name']
+            self.type_of[bucket_id] = bucket.get('type_name') or type_names.get(bucket.get('type_id'))
+            self.children[bucket_id] = tuple(item['id'] for item in bucket['items'])
+            for item in bucket['items']:
+                self.parent.setdefault(item['id'], bucket_id)
+                item_weights[item['id']] = item.get('weight', 0) / float(0x10000)
+        self.ids = dict((name, item_id) for item_id, name in self.names.items())
+        self.roots = [bucket_id for bucket_id in self.children if bucket_id not in self.parent]
+
+        # bottom-up: subtree weights and OSD sets; top-down: ancestors by type
+        self.weight, self.osds_under, self._ancestry = {}, {}, {}
+        for root in self.roots:
+            self._ancestry[root] = {}
+            stack = [(root, False)]
+            while stack:
+                item_id, expanded = stack.pop()
+                children = self.children.get(item_id, ())
+                if not expanded:
+                    stack.append((item_id, True))
+                    ancestry = dict(self._ancestry[item_id])
+                    ancestry[self.type_of[item_id]] = item_id
+                    for child in children:
+                        self._ancestry[child] = ancestry
+                        stack.append((child, False))
+                elif item_id >= 0:
+                    self.weight[item_id] = item_weights.get(item_id, 0.0)
+                    self.osds_under[item_id] = frozenset((item_id, ))
+                else:
+                    self.weight[item_id] = sum(self.weight[child] for child in children)
+                    self.osds_under[item_id] = frozenset().union(*[self.osds_under[child] for child in children])
+        self.rules = {}
+        self._rule_names = {}
+        for rule in crush_map.get('rules', ()):
+            self.rules[rule.get('rule_id', rule.get('ruleset'))] = rule
+            self._rule_names[rule.get('rule_name')] = rule
+        self._domains = {}
+        self._rule_osds = {}
+
+    def __repr__(self):
+        return '<%s: %d osds, %d buckets, version %s>' % (
+            self.__class__.__name__, len(self.names) - len(self.children), len(self.children), self.version)
+
+    def id_of(self, item):
+        """
+        CRUSH id of an id or name (e.g. 'osd.12', 'rack1')
+        """
+        return item if isinstance(item, int) else self.ids[item]
+
+    def ancestors(self, item):
+        """
+        Bucket ids above item, from its parent up to the root
+        """
+        result = []
+        item = self.parent.get(self.id_of(item))
+        while item is not None:
+            result.append(item)
+            item = self.parent.get(item)
+        return result
+
+    def failure_domain(self, item, type='host'):
+        """
+        Id of the bucket of `type` above item (itself if of that type), or None
+        """
+        item = self.id_of(item)
+        ancestry = self._ancestry.get(item, {})
+        if self.type_of.get(item) == type:
+            return item
+        return ancestry.get(type)
+
+    def domains(self, type='host'):
+        """
+        {bucket id: frozenset of OSD ids} of the buckets of `type`
+        """
+        domains = self._domains.get(type)
+        if domains is None:
+            domains = self._domains[type] = dict(
+                (bucket_id, self.osds_under.get(bucket_id, frozenset()))
+                for bucket_id in self.children if self.type_of[bucket_id] == type)
+        return domains
+
+    def rule(self, rule):
+        """
+        Rule by id (or ruleset) or name
+        """
+        if isinstance(rule, dict):
+            return rule
+        if rule in self._rule_names:
+            return self._rule_names[rule]
+        if rule in self.rules:
+            return self.rules[rule]
+        for candidate in self.rules.values():
+            if candidate.get('ruleset') == rule:
+                return candidate
+        raise KeyError(rule)
+
+    def rule_osds(self, rule):
+        """
+        OSD ids the rule can place data on, under its take steps
+        """
+        rule = self.rule(rule)
+        rule_id = rule.get('rule_id', rule.get('ruleset'))
+        if rule_id in self._rule_osds:
+            return self._rule_osds[rule_id]
+        osds = set()
+        for step in rule['steps']:
+            if step['op'] == 'take':
+                item = step.get('item')
+                if item is None or item not in self.osds_under:
+                    item = self.ids.get(step.get('item_name'))
+                osds.update(self.osds_under.get(item, ()))
+        osds = self._rule_osds[rule_id] = frozenset(osds)
+        return osds
+
+    def rule_failure_domain(self, rule):
+        """
+        Bucket type the rule spreads replicas over, e.g. 'host'
+        """
+        for step in self.rule(rule)['steps']:
+            if step['op'].startswith('choose'):
+                return step.get('type')
+        return None
+
+    @staticmethod
+    def _osd_status(osds):
+        status = {}
+        for osd in osds:
+            osd_id = osd.get('id', osd.get('osd'))
+            status[osd_id] = (bool(osd.get('up')), bool(osd.get('in')))
+        return status
+
+    def domain_status(self, osds, type='host'):
+        """
+        Join with cluster_osd_list (or OSDRecords): {bucket name: Counter of
+        total / up / down / in / out OSDs} of the buckets of `type`
+        """
+        status = self._osd_status(osds)
+        result = {}
+        for bucket_id, members in self.domains(type).items():
+            counts = collections.Counter(total=len(members))
+            for osd_id in members:
+                up, in_ = status.get(osd_id, (None, None))
+                if up is not None:
+                    counts['up' if up else 'down'] += 1
+                    counts['in' if in_ else 'out'] += 1
+            result[self.names[bucket_id]] = counts
+        return result
+
+    def impact(self, osds, rule=None, type=None):
+        """
+        What the down / out OSDs of `osds` (cluster_osd_list items) mean for
+        a rule, or the whole map
+
+        :arg type: failure domain type, by default the rule's, or 'host'
+        :return: {'down': [osd ids], 'out': [osd ids], 'weight_unavailable':
+                  fraction of the CRUSH weight on down or out OSDs,
+                  'degraded': [names of domains with a down OSD],
+                  'lost': [names of domains with all their OSDs down]}
+        """
+        status = self._osd_status(osds)
+        scope = self.rule_osds(rule) if rule is not None else frozenset(
+            item_id for item_id in self.osds_under if item_id >= 0)
+        type = type or (self.rule_failure_domain(rule) if rule is not None else None) or 'host'
+        down = sorted(osd_id for osd_id in scope if status.get(osd_id, (True, True))[0] is False)
+        out = sorted(osd_id for osd_id in scope if status.get(osd_id, (True, True))[1] is False)
+        total = sum(self.weight.get(osd_id, 0.0) for osd_id in scope)
+        unavailable = sum(self.weight.get(osd_id, 0.0) for osd_id in set(down) | set(out))
+        degraded = set(self.failure_domain(osd_id, type) for osd_id in down) - set([None])
+        lost = [bucket_id for bucket_id in degraded
+                if all(status.get(osd_id, (True, ))[0] is False
+                       for osd_id in self.osds_under[bucket_id] & scope)]
+        return {
+            'down': down,
+            'out': out,
+            'weight_unavailable': unavailable / total if total else 0.0,
+            'degraded': sorted(self.names[bucket_id] for bucket_id in degraded),
+            'lost': sorted(self.names[bucket_id] for bucket_id in lost),
+        }
+
+
+class SyncObjectTracker(object):
+    """
+    Keep the sync objects (osd_map, mon_status, health...) of a cluster up
+    to date, refetching only the ones whose version changed
+
+    refresh() reads the versions reported by cluster_get(fsid) and fetches
+    the changed sync objects concurrently. Without versions (older
+    backends) every sync object is fetched and compared. It returns the
+    diffs of the changed objects, by sync type:
+
+    - osd_map: epoch, osds added / removed, up / down / in / out,
+      reweighted ({id: (old, new)}), pools added / removed / changed
+      ({id: {field: (old, new)}})
+    - mon_status: epoch, quorum joined / left (ranks)
+    - others: the old and new version
+
+    A diff is None for the first fetch of a sync object. Hooks added with
+    add_hook() are called with (sync_type, old, new, diff) on every change.
+    A sync object whose fetch failed keeps its previous value and is
+    fetched again on the next refresh; `errors` holds the exceptions of the
+    last refresh, by sync type, as BulkResult.error does.
+    """
+    def __init__(self, connection, fsid, sync_types=None, max_workers=None):
+        self.connection = connection
+        self.fsid = fsid
+        self.sync_types = sync_types
+        self.max_workers = max_workers
+        self.hooks = []
+        self.objects = {}
+        self.versions = {}
+        self.errors = {}
+        self.fetches = 0
+        self._lock = threading.Lock()
+
+    def __getitem__(self, sync_type):
+        return self.objects[sync_type]
+
+    def get(self, sync_type, default=None):
+        return self.objects.get(sync_type, default)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def _remote_versions(self):
+        versions = self.connection.cluster_get(self.fsid).get('versions') or {}
+        sync_types = self.sync_types
+        if sync_types is None:
+            sync_types = list(versions) or self.connection.cluster_sync_object_list(self.fsid)
+        return dict((sync_type, versions.get(sync_type)) for sync_type in sync_types)
+
+    def refresh(self):
+        """
+        Fetch the sync objects whose version changed
+
+        :return: {sync_type: diff} of the sync objects which changed
+        """
+        with self._lock:
+            remote = self._remote_versions()
+            stale = [sync_type for sync_type, version in sorted(remote.items())
+                     if version is None or sync_type not in self.objects or
+                     self.versions.get(sync_type) != version]
+            results = self.connection.map_concurrent(
+                lambda sync_type: self.connection.cluster_sync_object_get(self.fsid, sync_type),
+                stale, max_workers=self.max_workers)
+            self.fetches += len(stale)
+            self.errors = {}
+            changes = []
+            for result in results:
+                if result.error is not None:
+                    LOG.warning('Sync object %s of %s fetch failed: %s', result.key, self.fsid, result.error)
+                    self.errors[result.key] = result.error
+                    continue
+                sync_type, new = result.key, result.data
+                old, old_version = self.objects.get(sync_type), self.versions.get(sync_type)
+                self.objects[sync_type] = new
+                self.versions[sync_type] = remote[sync_type]
+                if old is None or old != new:
+                    diff = None
+                    if old is not None:
+                        diff = self.diff(sync_type, old, new, (old_version, remote[sync_type]))
+                    changes.append((sync_type, old, new, diff))
+        for change in changes:
+            for hook in self.hooks:
+                try:
+                    hook(*change)
+                except Exception:
+                    LOG.exception('Sync object hook %r failed', hook)
+        return dict((sync_type, diff) for sync_type, _, _, diff in changes)
+
+    @classmethod
+    def diff(cls, sync_type, old, new, versions=(None, None)):
+        if sync_type == 'osd_map':
+            return cls.diff_osd_map(old, new)
+        if sync_type == 'mon_status':
+            old_quorum, new_quorum = set(old.get('quorum', ())), set(new.get('quorum', ()))
+            return {'epoch': (old.get('epoch'), new.get('epoch')),
+                    'quorum_joined': sorted(new_quorum - old_quorum),
+                    'quorum_left': sorted(old_quorum - new_quorum)}
+        return {'version': versions}
+
+    @staticmethod
+    def diff_osd_map(old, new):
+        old_osds = dict((osd['osd'], osd) for osd in old.get('osds', ()))
+        new_osds = dict((osd['osd'], osd) for osd in new.get('osds', ()))
+        diff = {'epoch': (old.get('epoch'), new.get('epoch')),
+                'osds_added': sorted(set(new_osds) - set(old_osds)),
+                'osds_removed': sorted(set(old_osds) - set(new_osds)),
+                'up': [], 'down': [], 'in': [], 'out': [], 'reweighted': {}}
+        for osd_id in sorted(set(old_osds) & set(new_osds)):
+            before, after = old_osds[osd_id], new_osds[osd_id]
+            if before.get('up') != after.get('up'):
+                diff['up' if after.get('up') else 'down'].append(osd_id)
+            if before.get('in') != after.get('in'):
+                diff['in' if after.get('in') else 'out'].append(osd_id)
+            if before.get('weight') != after.get('weight'):
+                diff['reweighted'][osd_id] = (before.get('weight'), after.get('weight'))
+        old_pools = dict((pool['pool'], pool) for pool in old.get('pools', ()))
+        new_pools = dict((pool['pool'], pool) for pool in new.get('pools', ()))
+        diff['pools_added'] = sorted(set(new_pools) - set(old_pools))
+        diff['pools_removed'] = sorted(set(old_pools) - set(new_pools))
+        diff['pools_changed'] = {}
+        for pool_id in sorted(set(old_pools) & set(new_pools)):
+            before, after = old_pools[pool_id], new_pools[pool_id]
+            changed = dict((key, (before.get(key), after.get(key)))
+                           for key in set(before) | set(after) if before.get(key) != after.get(key))
+            if changed:
+                diff['pools_changed'][pool_id] = changed
+        return diff
+
+
+class ClusterSnapshot(object):
+    """
+    Read-only view of a cluster built by ClusterSnapshotPipeline
+
+    Pieces (osds, pools, crush_map...) are attributes and items, e.g.
+    snapshot.osds or snapshot['crush_map']; do not modify them in place,
+    they are shared with the snapshots refreshed from this one.
+
+    :attr versions: sync object versions reported by cluster_get when the
+                    snapshot was completed
+    :attr consistent: False if the versions of the sync objects some pieces
+                      depend on still changed while they were fetched
+    :attr errors: {piece: exception} of the pieces which could not be fetched
+    """
+    __slots__ = ('fsid', 'cluster', 'versions', 'consistent', 'errors', 'taken', '_pieces')
+
+    def __init__(self, fsid, cluster, versions, consistent, pieces, errors, taken=None):
+        for name, value in (('fsid', fsid), ('cluster', cluster), ('versions', dict(versions)),
+                            ('consistent', consistent), ('_pieces', dict(pieces)),
+                            ('errors', dict(errors)), ('taken', taken or time.time())):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is read-only' % (self.__class__.__name__, ))
+
+    def __getattr__(self, name):
+        try:
+            return self._pieces[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, name):
+        return self._pieces[name]
+
+    def __contains__(self, name):
+        return name in self._pieces
+
+    def __repr__(self):
+        return '<%s: %s%s>' % (self.__class__.__name__, self.fsid, '' if self.consistent else ' (inconsistent)')
+
+    def get(self, name, default=None):
+        return self._pieces.get(name, default)
+
+    def keys(self):
+        return list(self._pieces)
+
+
+def _snapshot_mon_status(connection, fsid, pieces):
+    results = connection.cluster_mon_status_many(fsid, [mon['name'] for mon in pieces['mons']])
+    for result in results:
+        if result.error is not None:
+            raise result.error
+    return dict((result.key, result.data) for result in results)
+
+
+class ClusterSnapshotPipeline(object):
+    """
+    Build ClusterSnapshots of many clusters at once
+
+    The pieces of all the clusters are fetched on one thread pool, each
+    one as soon as the pieces it depends on are there. cluster_get is read
+    before and after: the pieces whose sync object version changed in the
+    meantime are fetched again, up to `retries` times. Refreshing a
+    previous snapshot only fetches the pieces whose version changed, and
+    the unversioned ones.
+
+    :arg pieces: names of PIECES to fetch, all by default
+    """
+    # name: (fetch(connection, fsid, pieces fetched so far), dependencies, sync type)
+    PIECES = collections.OrderedDict([
+        ('health', (lambda c, fsid, _: c.cluster_sync_object_get(fsid, 'health'), (), 'health')),
+        ('osds', (lambda c, fsid, _: c.cluster_osd_list(fsid), (), 'osd_map')),
+        ('pools', (lambda c, fsid, _: c.cluster_pool_list(fsid), (), 'osd_map')),
+        ('osd_config', (lambda c, fsid, _: c.cluster_osd_config(fsid), (), 'osd_map')),
+        ('crush_map', (lambda c, fsid, _: c.cluster_crush_map(fsid), (), 'osd_map')),
+        ('mons', (lambda c, fsid, _: c.cluster_mon_list(fsid), (), 'mon_status')),
+        ('mon_status', (_snapshot_mon_status, ('mons', ), 'mon_status')),
+        ('pg_summary', (lambda c, fsid, _: c.cluster_sync_object_get(fsid, 'pg_summary'), (), 'pg_summary')),
+        ('config', (lambda c, fsid, _: c.cluster_config_list(fsid), (), 'config')),
+        ('servers', (lambda c, fsid, _: c.cluster_server_list(fsid), (), None)),
+    ])
+
+    def __init__(self, connection, pieces=None, retries=2, max_workers=None):
+        self.connection = connection
+        self.pieces = list(pieces) if pieces is not None else list(self.PIECES)
+        for name in self.pieces:
+            for dependency in self.PIECES[name][1]:
+                if dependency not in self.pieces:
+                    raise ValueError('Snapshot piece %r needs %r' % (name, dependency))
+        self.retries = retries
+        self.max_workers = max_workers or connection.max_workers
+
+    def _with_dependents(self, names):
+        names = set(names)
+        added = True
+        while added:
+            added = False
+            for name in self.pieces:
+                if name not in names and names.intersection(self.PIECES[name][1]):
+                    names.add(name)
+                    added = True
+        return names
+
+    def _stale(self, names, old_versions, new_versions):
+        """
+        Pieces of names depending on a sync object whose version changed, or unversioned
+        """
+        return self._with_dependents(
+            name for name in names
+            if self.PIECES[name][2] is None or
+            old_versions.get(self.PIECES[name][2]) != new_versions.get(self.PIECES[name][2]) or
+            self.PIECES[name][2] not in new_versions)
+
+    def _clusters(self, executor, fsids):
+        futures = [(fsid, executor.submit(self.connection.cluster_get, fsid)) for fsid in fsids]
+        results = {}
+        for fsid, future in futures:
+            try:
+                results[fsid] = future.result()
+            except Exception as e:
+                results[fsid] = e
+        return results
+
+    def _fetch(self, executor, jobs, pieces, errors):
+        """
+        Fetch the (fsid, piece) jobs, dependencies first, into pieces[fsid] / errors[fsid]
+        """
+        pending = set(jobs)
+        running = {}
+        while pending or running:
+            for job in sorted(pending):
+                fsid, name = job
+                fetch, dependencies, _ = self.PIECES[name]
+                if any((fsid, dependency) in pending or (fsid, dependency) in running.values()
+                       for dependency in dependencies):
+                    continue
+                pending.discard(job)
+                failed = [dependency for dependency in dependencies if dependency in errors[fsid]]
+                if failed:
+                    errors[fsid][name] = errors[fsid][failed[0]]
+                    pieces[fsid].pop(name, None)
+                    continue
+                running[executor.submit(fetch, self.connection, fsid, pieces[fsid])] = job
+            if not running:
+                continue
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                fsid, name = running.pop(future)
+                try:
+                    pieces[fsid][name] = future.result()
+                    errors[fsid].pop(name, None)
+                except Exception as e:
+                    LOG.debug('Snapshot piece %s of cluster %s failed: %s', name, fsid, e)
+                    errors[fsid][name] = e
+                    pieces[fsid].pop(name, None)
+
+    def take(self, fsids, previous=None):
+        """
+        Snapshots of the clusters fsids
+
+        :arg previous: snapshots to refresh, only their stale pieces are fetched
+        :return: list of BulkResult(fsid, ClusterSnapshot, error) in fsids
+                 order, error being set when cluster_get itself failed
+        """
+        fsids = list(fsids)
+        previous = dict((snapshot.fsid, snapshot) for snapshot in previous or ())
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            clusters = self._clusters(executor, fsids)
+            live = [fsid for fsid in fsids if not isinstance(clusters[fsid], Exception)]
+            pieces, errors, jobs = {}, {}, []
+            for fsid in live:
+                versions = clusters[fsid].get('versions') or {}
+                snapshot = previous.get(fsid)
+                if snapshot is None:
+                    pieces[fsid], errors[fsid], names = {}, {}, self.pieces
+                else:
+                    pieces[fsid], errors[fsid] = dict(snapshot._pieces), dict(snapshot.errors)
+                    names = self._stale(self.pieces, snapshot.versions, versions)
+                    names.update(name for name in self.pieces
+                                 if name not in pieces[fsid] or name in errors[fsid])
+                jobs.extend((fsid, name) for name in names)
+            for attempt in range(self.retries + 1):
+                self._fetch(executor, jobs, pieces, errors)
+                after = self._clusters(executor, live)
+                jobs = []
+                for fsid in live:
+                    before_versions = clusters[fsid].get('versions') or {}
+                    if not isinstance(after[fsid], Exception):
+                        clusters[fsid] = after[fsid]
+                    versions = clusters[fsid].get('versions') or {}
+                    if before_versions == versions:
+                        continue
+                    changed = [name for name in self.pieces
+                               if self.PIECES[name][2] is not None and
+                               before_versions.get(self.PIECES[name][2]) != versions.get(self.PIECES[name][2])]
+                    jobs.extend((fsid, name) for name in self._with_dependents(changed))
+                if not jobs or attempt == self.retries:
+                    break
+                LOG.debug('Refetching %d stale snapshot pieces', len(jobs))
+        stale = set(fsid for fsid, _ in jobs)
+        results = []
+        for fsid in fsids:
+            cluster = clusters[fsid]
+            if isinstance(cluster, Exception):
+                results.append(BulkResult(fsid, None, cluster))
+                continue
+            snapshot = ClusterSnapshot(fsid, cluster, cluster.get('versions') or {}, fsid not in stale,
+                                       pieces[fsid], errors[fsid])
+            results.append(BulkResult(fsid, snapshot, None))
+        return results
+
+
+class LogFollower(object):
+    """
+    Follow a log tail endpoint, returning only the lines not seen yet
+
+    The cursor is the last `overlap` lines seen. Every poll fetches the
+    last `lines` lines and looks for the cursor in them; if it is not
+    there (more lines were written since), the window is doubled up to
+    max_lines. Past max_lines the lines in between are lost, which is
+    counted in `gaps`.
+
+    :arg fetch: fetch(lines) returning the log tail, {'lines': text} or text
+    :arg key: label of this follower in follow() results
+    :arg history: return the initial window on the first poll, instead of
+                  only the lines written after it
+    """
+    def __init__(self, fetch, key=None, lines=100, max_lines=10000, overlap=3, history=True):
+        self.fetch = fetch
+        self.key = key
+        self.lines = lines
+        self.max_lines = max_lines
+        self.overlap = overlap
+        self.history = history
+        self.gaps = 0
+        self.fetches = 0
+        self._tail = None
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.key)
+
+    @staticmethod
+    def _split(data):
+        if isinstance(data, dict):
+            data = data.get('lines') or ''
+        return data.splitlines() if not isinstance(data, list) else data
+
+    def _feed(self, window, lines):
+        """
+        New lines of a window of `lines` lines, None if a larger one is needed
+        """
+        self.fetches += 1
+        tail = self._tail
+        if tail is None:
+            new = window if self.history else []
+        else:
+            new = None
+            for index in range(len(window) - len(tail), -1, -1):
+                if tuple(window[index:index + len(tail)]) == tail:
+                    new = window[index + len(tail):]
+                    break
+            if new is None:
+                if len(window) >= lines and lines < self.max_lines:
+                    return None
+                self.gaps += 1
+                LOG.debug('Log %s moved past its cursor, lines may be missing', self.key)
+                new = window
+        if window:
+            self._tail = tuple(window[-self.overlap:])
+        return new
+
+    def poll(self):
+        """
+        Lines written since the last poll
+        """
+        lines = self.lines
+        while True:
+            new = self._feed(self._split(self.fetch(lines)), lines)
+            if new is not None:
+                return new
+            lines = min(lines * 2, self.max_lines)
+
+
+class EventFollower(object):
+    """
+    Follow an event list endpoint, returning only the events not seen yet
+
+    The cursor is the latest 'when' seen and the events seen at that
+    time (by 'id', or by when / severity / message).
+
+    :arg fetch: fetch() returning the events, a list or a paginated dict
+    """
+    def __init__(self, fetch, key=None, history=True):
+        self.fetch = fetch
+        self.key = key
+        self.history = history
+        self.fetches = 0
+        self._last = None
+        self._seen = set()
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.key)
+
+    @staticmethod
+    def event_key(event):
+        if 'id' in event:
+            return event['id']
+        return event.get('when'), event.get('severity'), event.get('message')
+
+    def _feed(self, events):
+        first = not self.fetches
+        self.fetches += 1
+        if isinstance(events, dict):  # paginated
+            events = events.get('results', [])
+        new = []
+        for event in sorted(events, key=lambda event: event.get('when') or ''):
+            when, key = event.get('when') or '', self.event_key(event)
+            if self._last is not None and (when < self._last or (when == self._last and key in self._seen)):
+                continue
+            if when != self._last:
+                self._last, self._seen = when, set()
+            self._seen.add(key)
+            new.append(event)
+        if first and not self.history:
+            return []
+        return new
+
+    def poll(self):
+        """
+        Events received since the last poll, oldest first
+        """
+        return self._feed(self.fetch())
+
+
+def follow(followers, interval=5, stop=None, max_workers=8):
+    """
+    Poll many followers concurrently, forever (or until `stop` is set)
+
+    Yields (follower.key, line or event). The next poll only starts once
+    the entries of the previous one are consumed and `interval` seconds
+    passed, so a slow consumer slows polling down instead of piling up
+    entries; log followers catch up by fetching larger windows.
+
+    :arg stop: threading.Event ending the generator
+    """
+    followers = list(followers)
+    stop = stop or threading.Event()
+
+    def poll(follower):
+        try:
+            return follower.poll()
+        except Exception as e:
+            LOG.warning('Polling %r failed: %s', follower, e)
+            return []
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(followers)))) as executor:
+        while not stop.is_set():
+            start = _now()
+            for follower, entries in zip(followers, executor.map(poll, followers)):
+                for entry in entries:
+                    yield follower.key, entry
+            stop.wait(max(0, interval - (_now() - start)))
+
+
+class Instrumentation(object):
+    """
+    Per endpoint metrics of a connection, rendered in Prometheus text format
+
+    Requests are keyed by method and URL template, e.g.
+    /api/v2/cluster/{fsid}/osd/{id} rather than the raw URL. Recorded:
+    latency, response bytes, status codes, JSON decode time, 403 re-auth
+    retries, backoff retries and response cache hits / misses.
+
+    Hooks added with add_hook() are called with every event, a dict with a
+    'type' of 'request', 'decode', 'reauth', 'retry' or 'cache', the 'method' and
+    'endpoint', and 'seconds' / 'bytes' / 'status' / 'hit' when relevant.
+    """
+    latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    decode_buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+    # collections whose next path segment is an id, and its placeholder
+    id_segments = {
+        'cluster': '{fsid}', 'osd': '{id}', 'pool': '{id}', 'mon': '{id}',
+        'server': '{fqdn}', 'request': '{id}', 'key': '{id}', 'user': '{id}',
+        'crush_node': '{id}', 'crush_type': '{id}', 'config': '{key}',
+        'sync_object': '{type}',
+    }
+
+    def __init__(self, prefix='calamari_client'):
+        self.prefix = prefix
+        self.hooks = []
+        self._lock = threading.Lock()
+        self._latency = {}  # (method, endpoint): [bucket counts, sum, count]
+        self._decode = {}
+        self._bytes = collections.Counter()  # (method, endpoint)
+        self._responses = collections.Counter()  # (method, endpoint, status)
+        self._reauth = collections.Counter()
+        self._cache = collections.Counter()  # (method, endpoint, 'hit'|'miss')
+        self._retries = collections.Counter()  # (method, endpoint, reason)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    @classmethod
+    def url_template(cls, url):
+        path = requests.compat.urlparse(url).path
+        segments = path.split('/')
+        result = []
+        index = 0
+        while index < len(segments):
+            segment = segments[index]
+            result.append(segment)
+            index += 1
+            if segment == 'log' and len(segments) > index and 'server' in result:
+                result.append('{path}')  # log file paths contain slashes
+                break
+            placeholder = cls.id_segments.get(segment)
+            if placeholder and index < len(segments) and segments[index]:
+                result.append(placeholder)
+                index += 1
+        return '/'.join(result)
+
+    def _observe(self, table, buckets, key, seconds):
+        entry = table.get(key)
+        if entry is None:
+            entry = table[key] = [[0] * len(buckets), 0.0, 0]
+        index = bisect.bisect_left(buckets, seconds)
+        if index < len(buckets):
+            entry[0][index] += 1
+        entry[1] += seconds
+        entry[2] += 1
+
+    def _emit(self, event):
+        for hook in self.hooks:
+            try:
+                hook(event)
+            except Exception:
+                LOG.exception('Instrumentation hook %r failed', hook)
+
+    def record_request(self, method, url, status, seconds, size):
+        endpoint = self.url_template(url)
+        with self._lock:
+            self._observe(self._latency, self.latency_buckets, (method, endpoint), seconds)
+            self._bytes[(method, endpoint)] += size
+            self._responses[(method, endpoint, str(status))] += 1
+        self._emit({'type': 'request', 'method': method, 'endpoint': endpoint,
+                    'status': status, 'seconds': seconds, 'bytes': size})
+
+    def record_decode(self, method, url, seconds):
+        endpoint = self.url_template(url)
+        with self._lock:
+            self._observe(self._decode, self.decode_buckets, (method, endpoint), seconds)
+        self._emit({'type': 'decode', 'method': method, 'endpoint': endpoint, 'seconds': seconds})
+
+    def record_reauth(self, method, url):
+        endpoint = self.url_template(url)
+        with self._lock:
+            self._reauth[(method, endpoint)] += 1
+        self._emit({'type': 'reauth', 'method': method, 'endpoint': endpoint})
+
+    def record_retry(self, method, url, reason):
+        endpoint = self.url_template(url)
+        with self._lock:
+            self._retries[(method, endpoint, str(reason))] += 1
+        self._emit({'type': 'retry', 'method': method, 'endpoint': endpoint, 'reason': reason})
+
+    def record_cache(self, method, url, hit):
+        endpoint = self.url_template(url)
+        with self._lock:
+            self._cache[(method, endpoint, 'hit' if hit else 'miss')] += 1
+        self._emit({'type': 'cache', 'method': method, 'endpoint': endpoint, 'hit': hit})
+
+    @staticmethod
+    def _labels(**labels):
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{%s}' % ','.join('%s="%s"' % (k, escape(v)) for k, v in sorted(labels.items()))
+
+    def _render_histogram(self, lines, name, help_text, table, buckets):
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s histogram' % (name, ))
+        for (method, endpoint), (counts, total, count) in sorted(table.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %d' % (
+                    name, self._labels(method=method, endpoint=endpoint, le=repr(float(bound))), cumulative))
+            lines.append('%s_bucket%s %d' % (name, self._labels(method=method, endpoint=endpoint, le='+Inf'), count))
+            lines.append('%s_sum%s %r' % (name, self._labels(method=method, endpoint=endpoint), total))
+            lines.append('%s_count%s %d' % (name, self._labels(method=method, endpoint=endpoint), count))
+
+    def _render_counter(self, lines, name, help_text, counter, label_names):
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s counter' % (name, ))
+        for key, value in sorted(counter.items()):
+            lines.append('%s%s %d' % (name, self._labels(**dict(zip(label_names, key))), value))
+
+    def render_prometheus(self):
+        """
+        All metrics in the Prometheus text exposition format
+        """
+        lines = []
+        p = self.prefix
+        with self._lock:
+            self._render_histogram(lines, p + '_request_duration_seconds',
+                                   'Calamari HTTP request latency.', self._latency, self.latency_buckets)
+            self._render_counter(lines, p + '_response_bytes_total',
+                                 'Calamari HTTP response body bytes.', self._bytes, ('method', 'endpoint'))
+            self._render_counter(lines, p + '_responses_total', 'Calamari HTTP responses by status code.',
+                                 self._responses, ('method', 'endpoint', 'code'))
+            self._render_histogram(lines, p + '_json_decode_seconds',
+                                   'JSON decode time of Calamari responses.', self._decode, self.decode_buckets)
+            self._render_counter(lines, p + '_reauth_total', 'Requests retried after a 403 re-authentication.',
+                                 self._reauth, ('method', 'endpoint'))
+            self._render_counter(lines, p + '_cache_requests_total', 'Response cache lookups.',
+                                 self._cache, ('method', 'endpoint', 'result'))
+            self._render_counter(lines, p + '_retries_total', 'Requests retried after a backoff.',
+                                 self._retries, ('method', 'endpoint', 'reason'))
+        return '\n'.join(lines) + '\n'
+
+
+if hasattr(sys, 'intern'):
+    _intern = sys.intern
+else:  # python 2: intern() only takes byte strings, json decodes to unicode
+    _interned = {}
+    # the interned fields repeat across records, this only guards against
+    # a field with more distinct values than expected
+    _INTERNED_MAX = 10000
+
+    def _intern(value):
+        if len(_interned) >= _INTERNED_MAX:
+            _interned.clear()
+        return _interned.setdefault(value, value)
+
+
+class _Record(object):
+    """
+    Compact read-only record of an API listing item
+
+    The `fields` are kept in slots, the strings of the `interned` ones
+    (shared by many records, e.g. osd.server) interned. Every other field
+    is kept as one compact JSON string, decoded on the first access to
+    one of them, e.g. osd.crush_node_ancestry. Items also support
+    record['field'].
+    """
+    __slots__ = ('_extra', '_decoded')
+    fields = ()
+    interned = ()
+
+    def __init__(self, data):
+        for name in self.fields:
+            value = data.get(name)
+            if name in self.interned and isinstance(value, text_type):
+                value = _intern(value)
+            object.__setattr__(self, name, value)
+        extra = dict((key, value) for key, value in data.items() if key not in self.fields)
+        object.__setattr__(self, '_extra', json.dumps(extra, separators=(',', ':')) if extra else None)
+        object.__setattr__(self, '_decoded', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is read-only' % (self.__class__.__name__, ))
+
+    def __getattr__(self, name):
+        # only called for names which are not slots
+        if name.startswith('__') or self._extra is None:
+            raise AttributeError(name)
+        try:
+            return self._extras()[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def _extras(self):
+        if self._decoded is None:
+            object.__setattr__(self, '_decoded', json.loads(self._extra) if self._extra is not None else {})
+        return self._decoded
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        key = getattr(self, self.fields[0])
+        return '<%s: %s>' % (self.__class__.__name__, key)
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def to_dict(self):
+        data = dict(self._extras())
+        for name in self.fields:
+            data[name] = getattr(self, name)
+        return data
+
+    @classmethod
+    def from_list(cls, items):
+        return RecordList(cls(item) for item in items)
+
+
+class OSDRecord(_Record):
+    fields = ('id', 'uuid', 'up', 'in', 'reweight', 'server')
+    interned = ('server', )
+    __slots__ = fields
+
+
+class PoolRecord(_Record):
+    fields = ('id', 'name', 'size', 'min_size', 'pg_num', 'crush_ruleset')
+    __slots__ = fields
+
+
+class ServerRecord(_Record):
+    fields = ('fqdn', 'hostname', 'managed', 'last_contact', 'ceph_version',
+              'frontend_addr', 'backend_addr')
+    interned = ('ceph_version', )
+    __slots__ = fields
+
+
+class MonRecord(_Record):
+    fields = ('name', 'rank', 'in_quorum', 'server', 'addr')
+    interned = ('server', )
+    __slots__ = fields
+
+
+class RecordList(list):
+    """
+    List of records with lookups by field, e.g. osds.find('uuid', uuid)
+
+    The index of a field is built on its first lookup, call reindex()
+    after modifying the list.
+    """
+    def __init__(self, records=()):
+        super(RecordList, self).__init__(records)
+        self._indexes = {}
+
+    def index_by(self, field):
+        index = self._indexes.get(field)
+        if index is None:
+            index = self._indexes[field] = dict((record.get(field), record) for record in self)
+        return index
+
+    def find(self, field, value, default=None):
+        return self.index_by(field).get(value, default)
+
+    def by_id(self, record_id, default=None):
+        return self.find('id', record_id, default)
+
+    def by_uuid(self, uuid, default=None):
+        return self.find('uuid', uuid, default)
+
+    def by_fqdn(self, fqdn, default=None):
+        return self.find('fqdn', fqdn, default)
+
+    def by_name(self, name, default=None):
+        return self.find('name', name, default)
+
+    def reindex(self):
+        self._indexes = {}
 
 
 class CalamariConnection(requests.Session):
     """
     Base connection for Calamari backend with authentication
+
+    :arg max_workers: size of the thread pool used by the bulk (*_many)
+                      methods, the HTTP connection pool is sized to match
+    :arg cache: optional ResponseCache for api_get, POSTs to a cluster
+                invalidate its cached responses
+    :arg session_ttl: optional lifetime in seconds of a calamari session, the
+                      session is then refreshed before it expires
+    :arg instrumentation: optional Instrumentation recording every request
+    :arg json_decoder: function decoding the response bytes, defaults to
+                       json_loads (orjson / ujson when installed)
+    :arg limiter: optional AIMDLimiter shared by all the requests
+    :arg retry: optional RetryPolicy of GET requests
+    :arg rate_limits: optional RateLimits, per endpoint token buckets
+    :arg request_timeout: default requests timeout, in seconds
+
+    On a 403, only one thread logs in again, the others wait and retry with
+    its session cookie. Responses (gzip / deflate compressed, as requests
+    asks by default) are decoded from the raw bytes, without building a
+    text copy.
     """
-    def __init__(self, host, username, password, api_version):
+    _cluster_url_re = re.compile(r'^/?(cluster/[^/]+)')
+    # refresh the session at this fraction of session_ttl
+    session_refresh_ratio = 0.9
+
+    def __init__(self, host, username, password, api_version, max_workers=8, cache=None,
+                 session_ttl=None, instrumentation=None, json_decoder=None, limiter=None, retry=None,
+                 rate_limits=None, request_timeout=None):
         self.host = host.rstrip('/')
         self.username = username
         self.password = password
         self.api_version = api_version.strip('/')
+        self.max_workers = max_workers
+        self.cache = cache
+        self.session_ttl = session_ttl
+        self.instrumentation = instrumentation
+        self.json_decoder = json_decoder or json_loads
+        self.limiter = limiter
+        self.retry = retry
+        self.rate_limits = rate_limits
+        self.request_timeout = request_timeout
+        self.auth_generation = 0
+        self._auth_time = None
+        self._auth_lock = threading.Lock()
+        self._auth_events = collections.Counter()
         super(CalamariConnection, self).__init__()
+        adapter = HTTPAdapter(pool_maxsize=max(max_workers, 10))
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
 
     def __repr__(self):
         return '<%s: %s>' % (self.__class__.__name__, self.host)
@@ -196,52 +2942,195 @@ class CalamariConnection(requests.Session):
         LOG.info('Calamari %s connection re-authenticated.', self.api_version)
         url = '%s/%s' % (self.host, self.get_api_path('auth/login'))
         data = {'username': self.username, 'password': self.password}
-        return super(CalamariConnection, self).post(url, data=data)
+        resp = self._send('POST', url, data=data)
+        self._auth_events['login'] += 1
+        if not resp.ok:
+            self._auth_events['login_failure'] += 1
+        self._auth_time = _now()
+        self.auth_generation += 1
+        return resp
+
+    def reauthenticate(self, generation):
+        """
+        Log in again, unless another thread did since `generation`
+        (auth_generation read before the failed request)
+        """
+        with self._auth_lock:
+            if self.auth_generation != generation:
+                self._auth_events['reused'] += 1
+                return None
+            return self.authenticate()
+
+    def _check_session(self):
+        """
+        Refresh the session before it expires, return the auth generation
+        """
+        generation = self.auth_generation
+        if self.session_ttl is not None and (
+                self._auth_time is None or
+                _now() - self._auth_time > self.session_ttl * self.session_refresh_ratio):
+            with self._auth_lock:
+                if self.auth_generation == generation:
+                    self._auth_events['refresh'] += 1
+                    self.authenticate()
+            generation = self.auth_generation
+        return generation
+
+    def auth_stats(self):
+        """
+        Counters of authentication events: login, login_failure, reused (a
+        403 handled by another thread's login), refresh (before expiry), logout
+        """
+        return dict(self._auth_events)
 
     def logout(self):
         LOG.info('Calamari %s connection logout.', self.api_version)
         url = '%s/%s' % (self.host, self.get_api_path('auth/logout'))
-        return super(CalamariConnection, self).post(url)
+        self._auth_events['logout'] += 1
+        self._auth_time = None
+        return self._send('POST', url)
+
+    def _send(self, method, url, *args, **kwargs):
+        send = super(CalamariConnection, self).get if method == 'GET' else super(CalamariConnection, self).post
+        if self.request_timeout is not None:
+            kwargs.setdefault('timeout', self.request_timeout)
+        if self.rate_limits is not None:
+            self.rate_limits.acquire(url)
+        if self.limiter is not None:
+            start = self.limiter.acquire()
+            overloaded = True  # unless a response comes back
+            try:
+                resp = send(url, *args, **kwargs)
+                overloaded = resp.status_code == 429 or resp.status_code >= 500
+            finally:
+                self.limiter.release(start, overloaded)
+        else:
+            start = _now()
+            resp = send(url, *args, **kwargs)
+        if self.instrumentation is not None:
+            self.instrumentation.record_request(method, url, resp.status_code, _now() - start,
+                                                len(resp.content or b''))
+        return resp
+
+    def _decode_json(self, response):
+        if self.instrumentation is None:
+            return self.json_decoder(response.content)
+        start = _now()
+        data = self.json_decoder(response.content)
+        self.instrumentation.record_decode(response.request.method, response.url, _now() - start)
+        return data
 
     def get(self, url, *args, **kwargs):
         url = '%s/%s' % (self.host, url.lstrip('/'))
         LOG.debug('GET request for %s', url)
-        resp = super(CalamariConnection, self).get(url, *args, **kwargs)
-        if resp.status_code == 403:
-            self.authenticate()
-            resp = super(CalamariConnection, self).get(url, *args, **kwargs)
-        return resp
+        generation = self._check_session()
+        reauthenticated = False
+        attempt = 0
+        while True:
+            try:
+                resp = self._send('GET', url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if self.retry is None or attempt >= self.retry.retries:
+                    raise
+                reason, delay = e.__class__.__name__, self.retry.delay(attempt)
+            else:
+                if resp.status_code == 403 and not reauthenticated:
+                    self.reauthenticate(generation)
+                    if self.instrumentation is not None:
+                        self.instrumentation.record_reauth('GET', url)
+                    reauthenticated = True
+                    continue
+                if self.retry is None or attempt >= self.retry.retries or not self.retry.should_retry(resp):
+                    return resp
+                reason, delay = resp.status_code, self.retry.delay(attempt, resp)
+            LOG.debug('Retrying GET %s in %.2fs (%s)', url, delay, reason)
+            if self.instrumentation is not None:
+                self.instrumentation.record_retry('GET', url, reason)
+            time.sleep(delay)
+            attempt += 1
 
     def post(self, url, *args, **kwargs):
         url = '%s/%s' % (self.host, url.lstrip('/'))
         LOG.debug('POST request for %s', url)
-        resp = super(CalamariConnection, self).post(url, *args, **kwargs)
+        generation = self._check_session()
+        resp = self._send('POST', url, *args, **kwargs)
         if resp.status_code == 403:
-            self.authenticate()
-            resp = super(CalamariConnection, self).post(url, *args, **kwargs)
+            self.reauthenticate(generation)
+            if self.instrumentation is not None:
+                self.instrumentation.record_reauth('POST', url)
+            resp = self._send('POST', url, *args, **kwargs)
         return resp
 
     def api_get(self, url, *args, **kwargs):
+        if self.cache is not None and not args and set(kwargs) <= set(['params']):
+            if self.instrumentation is None:
+                return self.cache.get_or_load(url, kwargs.get('params'),
+                                              lambda: self._api_get(url, **kwargs), self.cache_namespace)
+            loaded = []
+
+            def load():
+                loaded.append(True)
+                return self._api_get(url, **kwargs)
+            data = self.cache.get_or_load(url, kwargs.get('params'), load, self.cache_namespace)
+            if self.cache.get_ttl(url) is not None:
+                self.instrumentation.record_cache('GET', '/' + self.get_api_path(url), hit=not loaded)
+            return data
+        return self._api_get(url, *args, **kwargs)
+
+    @property
+    def cache_namespace(self):
+        return '%s/%s' % (self.host, self.get_api_path(''))
+
+    def _api_get(self, url, *args, **kwargs):
         url = self.get_api_path(url)
         response = self.get(url, *args, **kwargs)
         response.raise_for_status()
-        return response.json()
+        return self._decode_json(response)
 
     def api_post(self, url, *args, **kwargs):
-        url = self.get_api_path(url)
-        response = self.post(url, *args, **kwargs)
+        match = self._cluster_url_re.match(url) if self.cache is not None else None
+        if match:
+            self.cache.invalidate(match.group(1))
+        try:
+            response = self.post(self.get_api_path(url), *args, **kwargs)
+        finally:
+            # again once the POST is done: GETs sent meanwhile may have
+            # cached the data as it was before
+            if match:
+                self.cache.invalidate(match.group(1))
         response.raise_for_status()
-        return response.json()
+        return self._decode_json(response)
+
+    def map_concurrent(self, func, keys, max_workers=None):
+        """
+        Call func(key) for every key on a bounded thread pool sharing this session
+
+        :arg max_workers: defaults to self.max_workers
+        :return: list of BulkResult, in the order of keys. A failed item
+                 carries its exception in `error` instead of raising
+        """
+        keys = list(keys)
+        if not keys:
+            return []
 
+        def call(key):
+            try:
+                return BulkResult(key, func(key), None)
+            except Exception as e:
+                LOG.debug('Bulk request for %r failed: %s', key, e)
+                return BulkResult(key, None, e)
 
-class CalamariAPIv1Connection(CalamariConnection, CalamariGraphiteMixin):
+        workers = min(max_workers or self.max_workers, len(keys))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(call, keys))
+
+
+class CalamariAPIv1Mixin(object):
     """
-    For v1 APIs only
+    v1 API methods, shared by the blocking and the asyncio connections
 
     v1 API URL list: https://github.com/ceph/calamari/blob/master/rest-api/calamari_rest/urls/v1.py
     """
-    def __init__(self, host, username, password):
-        super(CalamariAPIv1Connection, self).__init__(host, username, password, 'v1')
 
     def info(self):
         return self.api_get('/info')
@@ -274,15 +3163,29 @@ class CalamariAPIv1Connection(CalamariConnection, CalamariGraphiteMixin):
         return self.api_get('/cluster/%s/server' % (fsid,))
 
 
-class CalamariAPIv2Connection(CalamariConnection, CalamariGraphiteMixin):
+class CalamariAPIv1Connection(CalamariConnection, CalamariAPIv1Mixin, CalamariGraphiteMixin):
     """
-    For v2 APIs only
+    For v1 APIs only
+
+    v1 API URL list: https://github.com/ceph/calamari/blob/master/rest-api/calamari_rest/urls/v1.py
+    """
+    def __init__(self, host, username, password, **kwargs):
+        super(CalamariAPIv1Connection, self).__init__(host, username, password, 'v1', **kwargs)
+
+    def osd_records(self, fsid):
+        """
+        osd_list()['osds'] as a RecordList of OSDRecord
+        """
+        return OSDRecord.from_list(self.osd_list(fsid)['osds'])
+
+
+class CalamariAPIv2Mixin(object):
+    """
+    v2 API methods, shared by the blocking and the asyncio connections
 
     v2 API list: http://calamari.readthedocs.org/en/latest/calamari_rest/resources/resources.html
     v2 API URL list: https://github.com/ceph/calamari/blob/master/rest-api/calamari_rest/urls/v2.py
     """
-    def __init__(self, host, username, password):
-        super(CalamariAPIv2Connection, self).__init__(host, username, password, 'v2')
 
     def cli(self, fsid, command):
         """ Ceph CLI access
@@ -370,10 +3273,12 @@ class CalamariAPIv2Connection(CalamariConnection, CalamariGraphiteMixin):
     def cluster_pool_get(self, fsid, pool_id):
         return self.api_get('/cluster/%s/pool/%s' % (fsid, pool_id))
 
-    def request_list(self, state=None):
+    def request_list(self, state=None, page=None):
         params = {}
         if state:
             params['state'] = state
+        if page:
+            params['page'] = page
         return self.api_get('/request', params=params)
 
     def request_get(self, request_id):
@@ -382,10 +3287,12 @@ class CalamariAPIv2Connection(CalamariConnection, CalamariGraphiteMixin):
     def request_cancel(self, request_id):
         return self.api_post('/request/%s/cancel' % (request_id,))
 
-    def cluster_request_list(self, fsid, state=None):
+    def cluster_request_list(self, fsid, state=None, page=None):
         params = {}
         if state:
             params['state'] = state
+        if page:
+            params['page'] = page
         return self.api_get('/cluster/%s/request' % (fsid,), params=params)
 
     def cluster_request_get(self, fsid, request_id):
@@ -426,3 +3333,296 @@ class CalamariAPIv2Connection(CalamariConnection, CalamariGraphiteMixin):
 
     def grains(self):
         return self.api_get('/grains')
+
+
+class CalamariAPIv2Connection(CalamariConnection, CalamariAPIv2Mixin, CalamariGraphiteMixin):
+    """
+    For v2 APIs only
+
+    v2 API list: http://calamari.readthedocs.org/en/latest/calamari_rest/resources/resources.html
+    v2 API URL list: https://github.com/ceph/calamari/blob/master/rest-api/calamari_rest/urls/v2.py
+    """
+    def __init__(self, host, username, password, **kwargs):
+        super(CalamariAPIv2Connection, self).__init__(host, username, password, 'v2', **kwargs)
+        self._crush_topologies = {}  # fsid: CrushTopology
+
+    def cluster_crush_topology(self, fsid):
+        """
+        CrushTopology of a cluster, rebuilt only when its osd_map version changes
+        """
+        version = (self.cluster_get(fsid).get('versions') or {}).get('osd_map')
+        topology = self._crush_topologies.get(fsid)
+        if topology is None or version is None or topology.version != version:
+            topology = self._crush_topologies[fsid] = CrushTopology(self.cluster_crush_map(fsid), version)
+        return topology
+
+    # Compact listings, as RecordList of slotted records with lookups
+    # (by_id, by_uuid, by_fqdn, by_name), see _Record
+
+    def cluster_osd_records(self, fsid):
+        return OSDRecord.from_list(self.cluster_osd_list(fsid))
+
+    def cluster_pool_records(self, fsid):
+        return PoolRecord.from_list(self.cluster_pool_list(fsid))
+
+    def cluster_server_records(self, fsid):
+        return ServerRecord.from_list(self.cluster_server_list(fsid))
+
+    def cluster_mon_records(self, fsid):
+        return MonRecord.from_list(self.cluster_mon_list(fsid))
+
+    # Bulk methods for the list-then-get-each patterns. If the ids are not
+    # given, they are read from the matching *_list call first. Every method
+    # returns a list of BulkResult in request order, see map_concurrent.
+
+    def cluster_osd_get_many(self, fsid, osd_ids=None, max_workers=None):
+        if osd_ids is None:
+            osd_ids = [osd['id'] for osd in self.cluster_osd_list(fsid)]
+        return self.map_concurrent(lambda osd_id: self.cluster_osd_get(fsid, osd_id),
+                                   osd_ids, max_workers=max_workers)
+
+    def cluster_mon_get_many(self, fsid, mon_ids=None, max_workers=None):
+        if mon_ids is None:
+            mon_ids = [mon['name'] for mon in self.cluster_mon_list(fsid)]
+        return self.map_concurrent(lambda mon_id: self.cluster_mon_get(fsid, mon_id),
+                                   mon_ids, max_workers=max_workers)
+
+    def cluster_mon_status_many(self, fsid, mon_ids=None, max_workers=None):
+        if mon_ids is None:
+            mon_ids = [mon['name'] for mon in self.cluster_mon_list(fsid)]
+        return self.map_concurrent(lambda mon_id: self.cluster_mon_status(fsid, mon_id),
+                                   mon_ids, max_workers=max_workers)
+
+    def cluster_pool_get_many(self, fsid, pool_ids=None, max_workers=None):
+        if pool_ids is None:
+            pool_ids = [pool['id'] for pool in self.cluster_pool_list(fsid)]
+        return self.map_concurrent(lambda pool_id: self.cluster_pool_get(fsid, pool_id),
+                                   pool_ids, max_workers=max_workers)
+
+    def cluster_server_get_many(self, fsid, fqdns=None, max_workers=None):
+        if fqdns is None:
+            fqdns = [server['fqdn'] for server in self.cluster_server_list(fsid)]
+        return self.map_concurrent(lambda fqdn: self.cluster_server_get(fsid, fqdn),
+                                   fqdns, max_workers=max_workers)
+
+    def cluster_sync_object_get_many(self, fsid, sync_types=None, max_workers=None):
+        if sync_types is None:
+            sync_types = self.cluster_sync_object_list(fsid)
+        return self.map_concurrent(lambda sync_type: self.cluster_sync_object_get(fsid, sync_type),
+                                   sync_types, max_workers=max_workers)
+
+    def sync_object_tracker(self, fsid, sync_types=None, max_workers=None):
+        """
+        SyncObjectTracker of a cluster, call its refresh() to update
+        """
+        return SyncObjectTracker(self, fsid, sync_types=sync_types, max_workers=max_workers)
+
+    def cluster_snapshot(self, fsid, previous=None, pieces=None, retries=2, max_workers=None):
+        """
+        ClusterSnapshot of a cluster, see ClusterSnapshotPipeline
+
+        :arg previous: snapshot to refresh, only its stale pieces are fetched
+        """
+        result = ClusterSnapshotPipeline(self, pieces, retries, max_workers).take(
+            [fsid], [previous] if previous is not None else None)[0]
+        if result.error is not None:
+            raise result.error
+        return result.data
+
+    def cluster_snapshot_many(self, fsids=None, previous=None, pieces=None, retries=2, max_workers=None):
+        """
+        ClusterSnapshots of many clusters (all by default), fetched together
+
+        :return: list of BulkResult(fsid, ClusterSnapshot, error)
+        """
+        if fsids is None:
+            fsids = [cluster['id'] for cluster in self.cluster_list()]
+        return ClusterSnapshotPipeline(self, pieces, retries, max_workers).take(fsids, previous)
+
+    def cluster_log_follower(self, fsid, **kwargs):
+        """
+        LogFollower of the cluster log, see follow()
+        """
+        return LogFollower(lambda lines: self.cluster_log_tail(fsid, lines=lines), key=fsid, **kwargs)
+
+    def server_log_follower(self, fqdn, log_path, **kwargs):
+        return LogFollower(lambda lines: self.server_log_file_tail(fqdn, log_path, lines=lines),
+                           key=(fqdn, log_path), **kwargs)
+
+    def event_follower(self, fsid=None, fqdn=None, **kwargs):
+        """
+        EventFollower of the events of a cluster, a server, or all of them
+        """
+        if fsid is not None:
+            return EventFollower(lambda: self.cluster_event_list(fsid), key=fsid, **kwargs)
+        if fqdn is not None:
+            return EventFollower(lambda: self.server_event_list(fqdn), key=fqdn, **kwargs)
+        return EventFollower(self.event_list, **kwargs)
+
+    def follow(self, followers, interval=5, stop=None, max_workers=None):
+        """
+        Yield (key, entry) of many followers polled over this session, see follow()
+        """
+        return follow(followers, interval, stop, max_workers or self.max_workers)
+
+    def request_wait(self, request_ids, fsid=None, timeout=600, **kwargs):
+        """
+        Block until all request_ids are complete, return their requests in
+        order. See RequestWaiter for the polling options
+
+        :arg timeout: seconds, see RequestWaiter.wait
+        """
+        return RequestWaiter(self, fsid=fsid, **kwargs).wait(request_ids, timeout=timeout)
+
+
+class _HostState(object):
+    __slots__ = ('connection', 'outstanding', 'latency', 'failures', 'ejections', 'ejected_until', 'requests')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.outstanding = 0
+        self.latency = None  # EWMA of request seconds
+        self.failures = 0  # consecutive
+        self.ejections = 0  # consecutive
+        self.ejected_until = 0
+        self.requests = 0
+
+
+class CalamariMultiHostConnection(CalamariAPIv2Connection):
+    """
+    v2 connection spread over several Calamari hosts serving the same clusters
+
+    Every host has its own session, connection pool and authentication.
+    Requests go to the host with the least outstanding requests
+    (strategy='least_outstanding'), or to a random host weighted by its
+    latency and load (strategy='latency'). After `max_failures` consecutive
+    failures (connection errors, timeouts, 5xx) a host is ejected for
+    `eject_time` seconds, doubled on every consecutive ejection; it is then
+    probed again by regular traffic. Failed GETs are retried on the other
+    hosts, POSTs are not. The connection itself has no connection pool or
+    session cookie, `host` is only the first host for reference.
+    """
+    latency_decay = 0.3
+
+    def __init__(self, hosts, username, password, strategy='least_outstanding', max_failures=3,
+                 eject_time=30, **kwargs):
+        if strategy not in ('least_outstanding', 'latency'):
+            raise ValueError('Unknown strategy %r' % (strategy, ))
+        super(CalamariMultiHostConnection, self).__init__(hosts[0], username, password, **kwargs)
+        # requests only go through the member connections: drop this
+        # session's own connection pool, a request sent through it fails
+        super(CalamariMultiHostConnection, self).close()
+        self.adapters.clear()
+        member_kwargs = dict((key, value) for key, value in kwargs.items()
+                             if key in ('max_workers', 'session_ttl', 'instrumentation', 'json_decoder',
+                                        'retry', 'rate_limits', 'request_timeout'))
+        limiter = kwargs.get('limiter')
+        self.members = [_HostState(CalamariAPIv2Connection(
+                            host, username, password,
+                            limiter=limiter.copy() if limiter is not None else None, **member_kwargs))
+                        for host in hosts]
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self._route_lock = threading.Lock()
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, ', '.join(m.connection.host for m in self.members))
+
+    def _choose(self, exclude):
+        now = _now()
+        with self._route_lock:
+            candidates = [m for m in self.members if m not in exclude and m.ejected_until <= now]
+            if not candidates:  # all ejected, try the one coming back first
+                candidates = sorted((m for m in self.members if m not in exclude),
+                                    key=lambda m: m.ejected_until)[:1]
+            if self.strategy == 'least_outstanding':
+                member = min(candidates, key=lambda m: (m.outstanding, m.latency or 0))
+            else:
+                weights = [1.0 / ((m.latency or 0.001) * (m.outstanding + 1)) for m in candidates]
+                point = random.random() * sum(weights)
+                for member, weight in zip(candidates, weights):
+                    point -= weight
+                    if point <= 0:
+                        break
+            member.outstanding += 1
+            member.requests += 1
+            return member
+
+    def _release(self, member, seconds, ok):
+        with self._route_lock:
+            member.outstanding -= 1
+            if member.latency is None:
+                member.latency = seconds
+            else:
+                member.latency += self.latency_decay * (seconds - member.latency)
+            if ok:
+                member.failures = 0
+                member.ejections = 0
+                return
+            member.failures += 1
+            if member.failures >= self.max_failures:
+                eject_time = self.eject_time * 2 ** member.ejections
+                LOG.warning('Calamari host %s ejected for %ss', member.connection.host, eject_time)
+                member.ejected_until = _now() + eject_time
+                member.ejections += 1
+                member.failures = 0
+
+    def _route(self, method, url, failover, *args, **kwargs):
+        tried = []
+        while True:
+            member = self._choose(tried)
+            tried.append(member)
+            can_retry = failover and len(tried) < len(self.members)
+            send = member.connection.get if method == 'GET' else member.connection.post
+            start = _now()
+            try:
+                resp = send(url, *args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self._release(member, _now() - start, ok=False)
+                if not can_retry:
+                    raise
+                LOG.warning('%s %s on %s failed (%s), retrying on another host',
+                            method, url, member.connection.host, e)
+                continue
+            ok = resp.status_code < 500
+            self._release(member, _now() - start, ok=ok)
+            if ok or not can_retry:
+                return resp
+            LOG.warning('%s %s on %s returned %s, retrying on another host',
+                        method, url, member.connection.host, resp.status_code)
+
+    def get(self, url, *args, **kwargs):
+        return self._route('GET', url, True, *args, **kwargs)
+
+    def post(self, url, *args, **kwargs):
+        return self._route('POST', url, False, *args, **kwargs)
+
+    def authenticate(self):
+        responses = [member.connection.authenticate() for member in self.members]
+        self.auth_generation += 1
+        return responses
+
+    def logout(self):
+        return [member.connection.logout() for member in self.members]
+
+    def auth_stats(self):
+        stats = collections.Counter()
+        for member in self.members:
+            stats.update(member.connection.auth_stats())
+        return dict(stats)
+
+    def host_stats(self):
+        """
+        Routing state of every host
+        """
+        now = _now()
+        with self._route_lock:
+            return [{'host': m.connection.host, 'requests': m.requests, 'outstanding': m.outstanding,
+                     'latency': m.latency, 'healthy': m.ejected_until <= now}
+                    for m in self.members]
+
+    def close(self):
+        for member in self.members:
+            member.connection.close()
+        super(CalamariMultiHostConnection, self).close()
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+asyncio counterparts of the calamari_client connections, based on aiohttp
+
+Every API / graph data method of the blocking connections is available here
+and returns an awaitable, e.g.
+
+    async with AsyncCalamariAPIv2Connection(host, username, password) as conn:
+        clusters = await conn.cluster_list()
+        osds = await asyncio.gather(*[conn.cluster_osd_get(fsid, osd['id'])
+                                      for osd in await conn.cluster_osd_list(fsid)])
+"""
+
+import asyncio
+import collections
+
+import aiohttp
+
+from calamari_client import (LOG, CalamariAPIv1Mixin, CalamariAPIv2Mixin, CalamariGraphiteMixin,
+                             EventFollower, GraphiteFrame, LogFollower, _now, json_loads)
+
+
+class AsyncCalamariGraphiteMixin(CalamariGraphiteMixin):
+    """
+    Graph data fetch methods from calamari frontend (romana), as coroutines
+
+    The per-level helpers (iops_data, server_cpu_data...) are inherited and
+    return the awaitable of graphite_data_get.
+    """
+
+    async def graphite_data_get(self, params, fetch=True, as_frame=False, incremental=False,
+                                max_points=None, step=None, consolidate='average'):
+        """
+        Base method to fetch graph data, see CalamariGraphiteMixin.graphite_data_get
+
+        :arg params: list of two-element tuples, not dict
+        """
+        if max_points is not None or step is not None:
+            params = self.graphite_consolidate_params(params, max_points, step, consolidate)
+        if not fetch:
+            return params
+        # the store does blocking file locking and I/O, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        store_plan = None
+        if self.graphite_store is not None:
+            store_plan = await loop.run_in_executor(None, self._graphite_store_plan, params)
+        if store_plan is not None:
+            data = None
+            if store_plan[-1] is not None:
+                data = await self._graphite_render(store_plan[-1])
+            return await loop.run_in_executor(None, self._graphite_store_commit, store_plan, data, as_frame)
+        plan = self._graphite_delta_plan(params) if incremental else None
+        if plan is not None and plan[2] is not None:
+            data = await self._graphite_render(plan[2])
+            data = self.graphite_delta_cache.merge(plan[0], plan[1], data, partial=True)
+            if data is None:
+                data = self.graphite_delta_cache.merge(
+                    plan[0], plan[1], await self._graphite_render(params), partial=False)
+        else:
+            data = await self._graphite_render(params)
+            if plan is not None:
+                data = self.graphite_delta_cache.merge(plan[0], plan[1], data, partial=False)
+        if as_frame:
+            return GraphiteFrame.from_json(data)
+        return data
+
+    async def _graphite_render(self, params):
+        params = list(params)
+        params.append(('format', 'json-array'))
+        data = await self.get('/graphite/render/', params=params)
+        return self._graphite_consolidated(params, await self._decode_json(data))
+
+    async def graphite_batch_get(self, calls, max_url_length=None, **kwargs):
+        """
+        Fetch the graph data of many helper calls in as few render requests
+        as possible, see CalamariGraphiteMixin.graphite_batch_get
+
+        The render requests run concurrently, within the connection limit.
+        """
+        as_frame = kwargs.pop('as_frame', False)
+        calls = list(calls)
+        helper_params = [await getattr(self, helper)(*args, fetch=False, **kwargs)
+                         for helper, args in self._graphite_batch_calls(calls)]
+        batches = self._graphite_batch_plan(helper_params, max_url_length)
+
+        async def fetch_batch(batch):
+            try:
+                data = await self.graphite_data_get(params=self._graphite_batch_params(batch),
+                                                    as_frame=as_frame)
+            except Exception as e:
+                LOG.debug('Batch graph data request failed: %s', e)
+                return batch, None, e
+            return batch, data, None
+
+        return self._graphite_batch_results(calls, await asyncio.gather(*[fetch_batch(b) for b in batches]))
+
+    async def graphite_fleet_get(self, pattern, time_from='-1d', max_url_length=None, **kwargs):
+        """
+        Graph data of every metric matching a pattern, see
+        CalamariGraphiteMixin.graphite_fleet_get
+        """
+        batches = self._graphite_fleet_batches(await self.graphite_metrics_find(pattern), time_from,
+                                               max_url_length)
+        frames = await asyncio.gather(*[self.graphite_data_get(params, as_frame=True, **kwargs)
+                                        for params in batches])
+        return GraphiteFrame.concat(frames)
+
+    async def graphite_fleet_top(self, pattern, k=10, by='average', rate=False, time_from='-1d', **kwargs):
+        frame = await self.graphite_fleet_get(pattern, time_from=time_from, **kwargs)
+        if rate:
+            frame = frame.rate()
+        return frame.top(k, by)
+
+    async def graphite_metrics_find(self, query, use_index=True):
+        """
+        Search for specific metrics (CPU/disk/NIC names of a server)
+
+        :arg use_index: answer from graphite_metric_index when it is crawled
+        """
+        index = self.graphite_metric_index
+        if use_index and index is not None and index.ready:
+            return index.find(query)
+        generation = self.auth_generation
+        data = await self.get('/graphite/metrics/find', params={'query': query})
+        try:
+            data = await self._decode_json(data)
+        except ValueError: # if data format error, need re-auth
+            await self.reauthenticate(generation)
+            data = await self.get('/graphite/metrics/find', params={'query': query})
+            data = await self._decode_json(data)
+        return data
+
+
+class AsyncLogFollower(LogFollower):
+    """
+    LogFollower whose fetch(lines) returns an awaitable
+    """
+    async def poll(self):
+        lines = self.lines
+        while True:
+            new = self._feed(self._split(await self.fetch(lines)), lines)
+            if new is not None:
+                return new
+            lines = min(lines * 2, self.max_lines)
+
+
+class AsyncEventFollower(EventFollower):
+    """
+    EventFollower whose fetch() returns an awaitable
+    """
+    async def poll(self):
+        return self._feed(await self.fetch())
+
+
+async def follow(followers, interval=5, stop=None):
+    """
+    Poll many async followers concurrently, see calamari_client.follow
+
+    Yields (follower.key, line or event) until `stop` (an asyncio.Event)
+    is set; the next poll waits for the previous entries to be consumed.
+    """
+    followers = list(followers)
+    stop = stop or asyncio.Event()
+
+    async def poll(follower):
+        try:
+            return await follower.poll()
+        except Exception as e:
+            LOG.warning('Polling %r failed: %s', follower, e)
+            return []
+
+    while not stop.is_set():
+        start = _now()
+        for follower, entries in zip(followers, await asyncio.gather(*[poll(f) for f in followers])):
+            for entry in entries:
+                yield follower.key, entry
+        try:
+            await asyncio.wait_for(stop.wait(), max(0, interval - (_now() - start)))
+        except asyncio.TimeoutError:
+            pass
+
+
+class AsyncCalamariConnection(object):
+    """
+    Base asyncio connection for Calamari backend with authentication
+
+    All requests share one aiohttp session (keep-alive connection pool of
+    `concurrency` connections), and at most `concurrency` requests are in
+    flight at the same time. Authentication works as in CalamariConnection:
+    one task logs in again on a 403 while the others wait for it, and the
+    session can be refreshed before `session_ttl` expires. Responses are
+    decoded from bytes with `json_decoder`, see CalamariConnection.
+    """
+    session_refresh_ratio = 0.9
+
+    def __init__(self, host, username, password, api_version, concurrency=32, session_ttl=None,
+                 instrumentation=None, json_decoder=None):
+        self.host = host.rstrip('/')
+        self.username = username
+        self.password = password
+        self.api_version = api_version.strip('/')
+        self.concurrency = concurrency
+        self.session_ttl = session_ttl
+        self.instrumentation = instrumentation
+        self.json_decoder = json_decoder or json_loads
+        self.auth_generation = 0
+        self._auth_time = None
+        # created on first use, inside the event loop: before python 3.10
+        # they bind to the loop current at creation, which may not be the
+        # one running the requests (e.g. a connection built before asyncio.run)
+        self._auth_lock = None
+        self._auth_events = collections.Counter()
+        self._semaphore = None
+        self._session = None
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.host)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.concurrency)
+            # unsafe: keep the session cookie for IP hosts, e.g. http://127.0.0.1/
+            cookie_jar = aiohttp.CookieJar(unsafe=True)
+            self._session = aiohttp.ClientSession(connector=connector, cookie_jar=cookie_jar)
+        return self._session
+
+    @property
+    def auth_lock(self):
+        if self._auth_lock is None:
+            self._auth_lock = asyncio.Lock()
+        return self._auth_lock
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        # the next session may run in another event loop
+        self._auth_lock = self._semaphore = None
+
+    def get_api_path(self, url):
+        return 'api/%s/%s' % (
+            self.api_version,
+            url.lstrip('/'))
+
+    async def _request(self, method, url, *args, **kwargs):
+        async with self.semaphore:
+            start = _now()
+            resp = await self.session.request(method, url, *args, **kwargs)
+            # reading the whole body releases the connection and keeps the
+            # body for _decode_json (a release() after it would drop it)
+            try:
+                body = await resp.read()
+            except BaseException:
+                resp.release()
+                raise
+        if self.instrumentation is not None:
+            self.instrumentation.record_request(method, url, resp.status, _now() - start, len(body))
+        return resp
+
+    async def _decode_json(self, response):
+        body = await response.read()  # already read by _request
+        if self.instrumentation is None:
+            return self.json_decoder(body)
+        start = _now()
+        data = self.json_decoder(body)
+        self.instrumentation.record_decode(response.method, str(response.url), _now() - start)
+        return data
+
+    async def authenticate(self):
+        LOG.info('Calamari %s connection re-authenticated.', self.api_version)
+        url = '%s/%s' % (self.host, self.get_api_path('auth/login'))
+        data = {'username': self.username, 'password': self.password}
+        resp = await self._request('POST', url, data=data)
+        self._auth_events['login'] += 1
+        if not resp.ok:
+            self._auth_events['login_failure'] += 1
+        self._auth_time = _now()
+        self.auth_generation += 1
+        return resp
+
+    async def reauthenticate(self, generation):
+        """
+        Log in again, unless another task did since `generation`
+        """
+        async with self.auth_lock:
+            if self.auth_generation != generation:
+                self._auth_events['reused'] += 1
+                return None
+            return await self.authenticate()
+
+    async def _check_session(self):
+        generation = self.auth_generation
+        if self.session_ttl is not None and (
+                self._auth_time is None or
+                _now() - self._auth_time > self.session_ttl * self.session_refresh_ratio):
+            async with self.auth_lock:
+                if self.auth_generation == generation:
+                    self._auth_events['refresh'] += 1
+                    await self.authenticate()
+            generation = self.auth_generation
+        return generation
+
+    def auth_stats(self):
+        return dict(self._auth_events)
+
+    async def logout(self):
+        LOG.info('Calamari %s connection logout.', self.api_version)
+        url = '%s/%s' % (self.host, self.get_api_path('auth/logout'))
+        self._auth_events['logout'] += 1
+        self._auth_time = None
+        return await self._request('POST', url)
+
+    async def get(self, url, *args, **kwargs):
+        url = '%s/%s' % (self.host, url.lstrip('/'))
+        LOG.debug('GET request for %s', url)
+        generation = await self._check_session()
+        resp = await self._request('GET', url, *args, **kwargs)
+        if resp.status == 403:
+            await self.reauthenticate(generation)
+            if self.instrumentation is not None:
+                self.instrumentation.record_reauth('GET', url)
+            resp = await self._request('GET', url, *args, **kwargs)
+        return resp
+
+    async def post(self, url, *args, **kwargs):
+        url = '%s/%s' % (self.host, url.lstrip('/'))
+        LOG.debug('POST request for %s', url)
+        generation = await self._check_session()
+        resp = await self._request('POST', url, *args, **kwargs)
+        if resp.status == 403:
+            await self.reauthenticate(generation)
+            if self.instrumentation is not None:
+                self.instrumentation.record_reauth('POST', url)
+            resp = await self._request('POST', url, *args, **kwargs)
+        return resp
+
+    async def api_get(self, url, *args, **kwargs):
+        url = self.get_api_path(url)
+        response = await self.get(url, *args, **kwargs)
+        response.raise_for_status()
+        return await self._decode_json(response)
+
+    async def api_post(self, url, *args, **kwargs):
+        url = self.get_api_path(url)
+        response = await self.post(url, *args, **kwargs)
+        response.raise_for_status()
+        return await self._decode_json(response)
+
+
+class AsyncCalamariAPIv1Connection(AsyncCalamariConnection, CalamariAPIv1Mixin, AsyncCalamariGraphiteMixin):
+    """
+    For v1 APIs only, asyncio version of CalamariAPIv1Connection
+    """
+    def __init__(self, host, username, password, **kwargs):
+        super(AsyncCalamariAPIv1Connection, self).__init__(host, username, password, 'v1', **kwargs)
+
+
+class AsyncCalamariAPIv2Connection(AsyncCalamariConnection, CalamariAPIv2Mixin, AsyncCalamariGraphiteMixin):
+    """
+    For v2 APIs only, asyncio version of CalamariAPIv2Connection
+    """
+    def __init__(self, host, username, password, **kwargs):
+        super(AsyncCalamariAPIv2Connection, self).__init__(host, username, password, 'v2', **kwargs)
+
+    def cluster_log_follower(self, fsid, **kwargs):
+        return AsyncLogFollower(lambda lines: self.cluster_log_tail(fsid, lines=lines), key=fsid, **kwargs)
+
+    def server_log_follower(self, fqdn, log_path, **kwargs):
+        return AsyncLogFollower(lambda lines: self.server_log_file_tail(fqdn, log_path, lines=lines),
+                                key=(fqdn, log_path), **kwargs)
+
+    def event_follower(self, fsid=None, fqdn=None, **kwargs):
+        if fsid is not None:
+            return AsyncEventFollower(lambda: self.cluster_event_list(fsid), key=fsid, **kwargs)
+        if fqdn is not None:
+            return AsyncEventFollower(lambda: self.server_event_list(fqdn), key=fqdn, **kwargs)
+        return AsyncEventFollower(self.event_list, **kwargs)
+
+    def follow(self, followers, interval=5, stop=None):
+        """
+        Async iterator of (key, entry) of many followers, see follow()
+        """
+        return follow(followers, interval, stop)
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Export the inventory and graph data of every Calamari cluster to files
+
+    calamari-export --host http://calamari/ --username admin --output export/ \\
+        --series server_cpu_data,server_disk_detail_data --time-from -7d --concurrency 16
+
+Layout of the output directory:
+
+    inventory/<fsid>/<kind>.ndjson       one item per line (osds, pools...)
+    series/<helper>/<entity>.ndjson      {"targets": [...]} line, then one
+                                         [timestamp, value, ...] line per point
+    series/<helper>/<entity>.npz         with --format columnar (numpy):
+                                         targets, timestamps, values arrays
+
+Every file is one task, written to a .part file and renamed when complete,
+then recorded in the .checkpoint file. With --resume, the tasks recorded
+there are skipped, so an interrupted export carries on where it stopped.
+Tasks are generated lazily and at most 2 x concurrency are in flight, and
+each task streams its lines out, so memory does not grow with the number
+of clusters, servers or devices. NDJSON series longer than --chunk are
+fetched and written one chunk (from / until slice) at a time, so memory
+does not grow with the time range either; the recent chunks, which graphite
+serves at 1min/point, are averaged to the step of the whole range.
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from calamari_client import CalamariAPIv2Connection, graphite_host, graphite_time_offset, numpy
+
+
+LOG = logging.getLogger(__name__)
+
+# name: connection method returning the items of a cluster
+INVENTORY = collections.OrderedDict([
+    ('cluster', 'cluster_get'),
+    ('osds', 'cluster_osd_list'),
+    ('pools', 'cluster_pool_list'),
+    ('servers', 'cluster_server_list'),
+    ('mons', 'cluster_mon_list'),
+    ('config', 'cluster_config_list'),
+    ('osd_config', 'cluster_osd_config'),
+    ('crush_nodes', 'cluster_crush_node_list'),
+    ('crush_map', 'cluster_crush_map'),
+])
+
+# graph data helper: (level, metrics_find pattern of the devices of a server)
+SERIES = collections.OrderedDict([
+    ('iops_data', ('cluster', None)),
+    ('disk_usage_data', ('cluster', None)),
+    ('server_cpu_data', ('server', None)),
+    ('server_loadavg_data', ('server', None)),
+    ('server_memory_data', ('server', None)),
+    ('server_cpu_detail_data', ('device', 'servers.%s.cpu.*')),
+    ('server_disk_detail_data', ('device', 'servers.%s.iostat.*')),
+    ('server_network_detail_data', ('device', 'servers.%s.network.*')),
+])
+DEFAULT_SERIES = [name for name, (level, _) in SERIES.items() if level != 'device']
+
+# one output file: id (its path relative to the output directory, without
+# extension) and write(directory) writing it
+ExportTask = collections.namedtuple('ExportTask', ['id', 'write'])
+
+
+class Checkpoint(object):
+    """
+    Append-only file of the completed task ids
+
+    :arg resume: keep the ids of a previous run, otherwise start over
+    """
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.done = set()
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                self.done.update(line.rstrip('\n') for line in f if line.strip())
+        self._file = open(path, 'a' if resume else 'w')
+        self._lock = threading.Lock()
+
+    def __contains__(self, task_id):
+        return task_id in self.done
+
+    def add(self, task_id):
+        with self._lock:
+            self._file.write(task_id + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.done.add(task_id)
+
+    def close(self):
+        self._file.close()
+
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _safe_name(name):
+    return str(name).replace(os.sep, '_').replace('/', '_')
+
+
+class _AtomicFile(object):
+    """
+    File written as path.part and renamed to path on success
+    """
+    def __init__(self, path, mode='w'):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:  # created by another task meanwhile
+                if not os.path.isdir(directory):
+                    raise
+        self.file = open(path + '.part', mode)
+
+    def __enter__(self):
+        return self.file
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        if exc_type is None:
+            _replace(self.path + '.part', self.path)
+        else:
+            os.remove(self.path + '.part')
+
+
+def _dump(data):
+    return json.dumps(data, separators=(',', ':'), sort_keys=True)
+
+
+def _resample(rows, step):
+    """
+    [timestamp, value, ...] rows averaged into one row per step, the way
+    graphite rolls 1min points up into 15min ones; rows already at that
+    step are returned unchanged
+    """
+    bucket, group = None, []
+    for row in rows + [None]:
+        ts = None if row is None else row[0] - row[0] % step
+        if group and ts != bucket:
+            if len(group) == 1:
+                yield [bucket] + group[0][1:]
+            else:
+                columns = [[value for value in column if value is not None] for column in zip(*group)]
+                yield [bucket] + [sum(values) / float(len(values)) if values else None
+                                  for values in columns[1:]]
+            group = []
+        bucket = ts
+        if row is not None:
+            group.append(row)
+
+
+class Exporter(object):
+    """
+    Generate and run the export tasks
+
+    :arg series: names of SERIES helpers to export
+    :arg fmt: 'ndjson', or 'columnar' for numpy .npz graph data
+    :arg chunk: seconds of NDJSON graph data fetched per request, longer
+                windows are streamed chunk by chunk
+    :arg graph_kwargs: passed to the helpers, e.g. time_from, max_points
+    """
+    def __init__(self, connection, output, series=DEFAULT_SERIES, inventory=True, fmt='ndjson',
+                 fsids=None, concurrency=8, resume=False, chunk=86400, **graph_kwargs):
+        if fmt == 'columnar' and numpy is None:
+            raise ImportError('numpy is required for the columnar format')
+        self.connection = connection
+        self.output = output
+        self.series = list(series)
+        self.inventory = inventory
+        self.fmt = fmt
+        self.fsids = fsids
+        self.concurrency = concurrency
+        self.resume = resume
+        self.chunk = chunk
+        self.graph_kwargs = graph_kwargs
+        self.stats = collections.Counter()
+
+    def tasks(self):
+        fsids = self.fsids or [cluster['id'] for cluster in self.connection.cluster_list()]
+        for fsid in fsids:
+            if self.inventory:
+                for kind, method in INVENTORY.items():
+                    yield ExportTask('inventory/%s/%s' % (fsid, kind),
+                                     self._inventory_writer(fsid, method))
+            fqdns = None
+            for helper in self.series:
+                level, pattern = SERIES[helper]
+                if level == 'cluster':
+                    yield ExportTask('series/%s/%s' % (helper, fsid), self._series_writer(helper, fsid))
+                    continue
+                if fqdns is None:
+                    fqdns = [server['fqdn'] for server in self.connection.cluster_server_list(fsid)]
+                for fqdn in fqdns:
+                    if level == 'server':
+                        yield ExportTask('series/%s/%s' % (helper, fqdn), self._series_writer(helper, fqdn))
+                    else:
+                        yield ExportTask('series/%s/%s' % (helper, fqdn),
+                                         self._device_writer(helper, pattern % (graphite_host(fqdn), )))
+
+    def _inventory_writer(self, fsid, method):
+        def write(path):
+            data = getattr(self.connection, method)(fsid)
+            if isinstance(data, dict) and 'results' in data:  # paginated
+                data = data['results']
+            with _AtomicFile(path + '.ndjson') as f:
+                for item in data if isinstance(data, list) else [data]:
+                    f.write(_dump(item) + '\n')
+        return write
+
+    def _chunks(self, params):
+        """
+        (params, start, end, step) slices of about self.chunk seconds, or
+        (params, None, None, None) if the window is short or consolidated.
+
+        The slices are aligned on the step graphite uses for the whole window
+        and hold whole steps, so the recent ones, served at a finer step, can
+        be resampled to match a single request. The last one has no end
+        """
+        values = dict(params)
+        window = graphite_time_offset(values.get('from', ''))
+        if (window is None or window <= self.chunk or 'until' in values or 'maxDataPoints' in values or
+                any(value.startswith('summarize(') for key, value in params if key == 'target')):
+            yield params, None, None, None
+            return
+        others = [(key, value) for key, value in params if key != 'from']
+        step = 60 if window <= self.connection.graphite_fine_window else 900
+        size = max(self.chunk // step, 1) * step
+        now = int(time.time())
+        # first point graphite returns for from=now - window
+        first = now - window - (now - window) % step + step
+        for start in range(first, now + 1, size):
+            end = start + size if start + size <= now else None
+            # from is exclusive and until inclusive
+            chunk = others + [('from', str(start - 1))]
+            if end is not None:
+                chunk.append(('until', str(end - 1)))
+            yield chunk, start, end, step
+
+    def _write_series(self, path, helper, entity):
+        method = getattr(self.connection, helper)
+        if self.fmt == 'columnar':
+            data = method(entity, as_frame=True, **self.graph_kwargs)
+            # numpy appends .npz to the name itself, and wants a binary file
+            with _AtomicFile(path + '.npz', 'wb') as f:
+                numpy.savez_compressed(f, targets=numpy.array(data.targets), timestamps=data.timestamps,
+                                       values=data.values)
+            return
+        params = method(entity, fetch=False, **self.graph_kwargs)
+        with _AtomicFile(path + '.ndjson') as f:
+            for index, (chunk, start, end, step) in enumerate(self._chunks(params)):
+                data = self.connection.graphite_data_get(chunk)
+                if index == 0:
+                    f.write(_dump({'targets': data['targets']}) + '\n')
+                rows = data['datapoints']
+                if step is not None:
+                    rows = _resample([row for row in rows if row[0] >= start and (end is None or row[0] < end)],
+                                     step)
+                for row in rows:
+                    f.write(_dump(row) + '\n')
+
+    def _series_writer(self, helper, entity):
+        def write(path):
+            self._write_series(path, helper, entity)
+        return write
+
+    def _device_writer(self, helper, pattern):
+        def write(path):
+            for device in self.connection.graphite_metrics_find(pattern):
+                self._write_series(os.path.join(path, _safe_name(device['text'])), helper, device['id'])
+        return write
+
+    def _run_task(self, task):
+        task.write(os.path.join(self.output, *[_safe_name(part) for part in task.id.split('/')]))
+
+    def run(self):
+        """
+        Run the tasks not in the checkpoint, return the number of failed ones
+        """
+        if not os.path.isdir(self.output):
+            os.makedirs(self.output)
+        checkpoint = Checkpoint(os.path.join(self.output, '.checkpoint'), resume=self.resume)
+        inflight = {}
+
+        def collect(futures):
+            for future in futures:
+                task = inflight.pop(future)
+                error = future.exception()
+                if error is None:
+                    checkpoint.add(task.id)
+                    self.stats['done'] += 1
+                    LOG.debug('Exported %s', task.id)
+                else:
+                    self.stats['failed'] += 1
+                    LOG.error('Export of %s failed: %s', task.id, error)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                for task in self.tasks():
+                    if task.id in checkpoint:
+                        self.stats['skipped'] += 1
+                        continue
+                    if len(inflight) >= 2 * self.concurrency:
+                        collect(wait(list(inflight), return_when=FIRST_COMPLETED)[0])
+                    inflight[executor.submit(self._run_task, task)] = task
+                collect(list(inflight))
+        finally:
+            checkpoint.close()
+        return self.stats['failed']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export Calamari inventory and graph data')
+    parser.add_argument('--host', required=True, help='e.g. http://calamari.example.com/')
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--password', default=os.environ.get('CALAMARI_PASSWORD'),
+                        help='defaults to the CALAMARI_PASSWORD environment variable')
+    parser.add_argument('--output', required=True, help='output directory')
+    parser.add_argument('--format', choices=['ndjson', 'columnar'], default='ndjson')
+    parser.add_argument('--cluster', action='append', dest='fsids', help='only this cluster (repeatable)')
+    parser.add_argument('--series', default=','.join(DEFAULT_SERIES),
+                        help='comma separated graph data helpers, or none. Available: %s' % (
+                            ', '.join(SERIES), ))
+    parser.add_argument('--no-inventory', dest='inventory', action='store_false')
+    parser.add_argument('--time-from', default='-1d', help='graphite from, e.g. -7d (default -1d)')
+    parser.add_argument('--max-points', type=int, help='consolidate each series to about this many points')
+    parser.add_argument('--chunk', type=int, default=86400,
+                        help='seconds of graph data per request, longer NDJSON series are streamed in chunks')
+    parser.add_argument('--concurrency', type=int, default=8, help='requests in flight')
+    parser.add_argument('--resume', action='store_true', help='skip the tasks done by a previous run')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    argv = list(sys.argv[1:] if argv is None else argv)
+    # argparse takes '-7d' for an option, so glue relative times to their flag
+    for index, arg in enumerate(argv[:-1]):
+        if arg == '--time-from' and argv[index + 1].startswith('-'):
+            argv[index:index + 2] = ['--time-from=' + argv[index + 1]]
+            break
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    series = [name.strip() for name in args.series.split(',') if name.strip() and name.strip() != 'none']
+    unknown = [name for name in series if name not in SERIES]
+    if unknown:
+        parser.error('unknown series %s' % (', '.join(unknown), ))
+    if args.password is None:
+        parser.error('--password or CALAMARI_PASSWORD is required')
+
+    connection = CalamariAPIv2Connection(args.host, args.username, args.password,
+                                         max_workers=args.concurrency)
+    graph_kwargs = {'time_from': args.time_from}
+    if args.max_points:
+        graph_kwargs['max_points'] = args.max_points
+    exporter = Exporter(connection, args.output, series=series, inventory=args.inventory, fmt=args.format,
+                        fsids=args.fsids, concurrency=args.concurrency, resume=args.resume, chunk=args.chunk,
+                        **graph_kwargs)
+    try:
+        failed = exporter.run()
+    finally:
+        connection.logout()
+    LOG.info('Exported %(done)d files, %(skipped)d already done, %(failed)d failed', exporter.stats)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
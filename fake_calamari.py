@@ -0,0 +1,653 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Local stand-in for a Calamari server, for benchmarks and manual tests
+
+Serves the v1/v2 REST routes, /graphite/render/ (json-array) and
+/graphite/metrics/find used by calamari_client, over synthetic clusters
+generated at a configurable scale, with optional injected latency.
+
+    python fake_calamari.py --port 8080 --osds 10000 --servers 500 --latency 0.005
+"""
+
+import argparse
+import collections
+import fnmatch
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, urlparse
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl, urlparse
+
+
+SESSION_COOKIE = 'sessionid'
+SYNC_TYPES = ['osd_map', 'mon_status', 'health', 'pg_summary', 'mds_map', 'config']
+
+
+class FakeCluster(object):
+    """
+    Synthetic ceph cluster: OSDs spread over servers, mons, pools, CRUSH map
+    """
+    def __init__(self, fsid, name, osds, servers, mons, pools, seed=0):
+        rnd = random.Random(seed)
+        self.fsid = fsid
+        self.name = name
+        self.versions = dict((sync_type, 1) for sync_type in SYNC_TYPES)
+        self.servers = []
+        for i in range(servers):
+            fqdn = 'node%04d.%s.example.com' % (i, name)
+            self.servers.append({
+                'fqdn': fqdn, 'hostname': fqdn.split('.')[0], 'managed': True,
+                'last_contact': '2016-01-28T02:10:00+00:00', 'boot_time': '2016-01-01T00:00:00+00:00',
+                'ceph_version': '0.94.5', 'services': [],
+                'frontend_addr': '10.0.%d.%d' % (i // 250, i % 250 + 1),
+                'backend_addr': '10.1.%d.%d' % (i // 250, i % 250 + 1),
+            })
+        self.osds = []
+        for i in range(osds):
+            server = self.servers[i % servers]
+            osd = {
+                'id': i, 'uuid': str(uuid.UUID(int=rnd.getrandbits(128))),
+                'up': rnd.random() > 0.01, 'in': rnd.random() > 0.005,
+                'reweight': 1.0, 'server': server['fqdn'], 'pools': [],
+                'public_addr': '%s:%d/%d' % (server['frontend_addr'], 6800 + i // servers, i),
+                'cluster_addr': '%s:%d/%d' % (server['backend_addr'], 6800 + i // servers, i),
+                'valid_commands': ['scrub', 'deep_scrub', 'repair'],
+                'crush_node_ancestry': [[-(i % servers) - 2, -1]],
+            }
+            self.osds.append(osd)
+            server['services'].append({'fsid': fsid, 'type': 'osd', 'id': str(i), 'running': osd['up']})
+        self.mons = []
+        for i in range(mons):
+            server = self.servers[i % servers]
+            self.mons.append({'name': server['hostname'], 'rank': i, 'in_quorum': True,
+                              'server': server['fqdn'], 'addr': '%s:6789/0' % server['frontend_addr']})
+            server['services'].append({'fsid': fsid, 'type': 'mon', 'id': server['hostname'], 'running': True})
+        self.pools = []
+        for i in range(pools):
+            self.pools.append({
+                'id': i, 'name': 'pool%d' % i, 'size': 3, 'min_size': 2, 'crush_ruleset': 0,
+                'pg_num': 1024, 'pgp_num': 1024, 'crash_replay_interval': 0,
+                'quota_max_objects': 0, 'quota_max_bytes': 0, 'full': False,
+                'hashpspool': True,
+            })
+            for osd in self.osds:
+                osd['pools'].append(i)
+        self.requests = {}
+        self.log = ['2016-01-28 02:10:%02d.000000 mon.0 %s:6789/0 %d : cluster [INF] pgmap v%d: active+clean'
+                    % (i % 60, self.servers[0]['frontend_addr'], i, i) for i in range(100)]
+        self.events = [{'id': i, 'when': '2016-01-28T02:%02d:00+00:00' % (i % 60), 'severity': 'INFO',
+                        'message': 'event %d' % i, 'fsid': fsid} for i in range(50)]
+
+    def summary(self):
+        return {'id': self.fsid, 'name': self.name, 'update_time': '2016-01-28T02:10:00+00:00',
+                'versions': dict(self.versions)}
+
+    def update_osd(self, osd_id, **changes):
+        """
+        Change an OSD (up, in, reweight...) and bump the osd_map version
+        """
+        self.osds[osd_id].update(changes)
+        self.versions['osd_map'] += 1
+
+    def update_pool(self, pool_id, **changes):
+        self.pools[pool_id].update(changes)
+        self.versions['osd_map'] += 1
+
+    def add_log_lines(self, count):
+        """
+        Append lines to the cluster log (also served as every server log)
+        """
+        for _ in range(count):
+            i = len(self.log)
+            self.log.append('2016-01-28 02:%02d:%02d.000000 mon.0 %s:6789/0 %d : cluster [INF] pgmap v%d: active+clean'
+                            % (i // 60 % 60, i % 60, self.servers[0]['frontend_addr'], i, i))
+
+    def add_event(self, message, severity='INFO'):
+        i = len(self.events)
+        self.events.append({'id': i, 'when': '2016-01-28T03:%02d:%02d+00:00' % (i // 60 % 60, i % 60),
+                            'severity': severity, 'message': message, 'fsid': self.fsid})
+
+    def crush_map(self):
+        hosts = []
+        for i, server in enumerate(self.servers):
+            items = [{'id': osd['id'], 'weight': 65536, 'pos': pos}
+                     for pos, osd in enumerate(self.osds[i::len(self.servers)])]
+            hosts.append({'id': -i - 2, 'name': server['hostname'], 'type_id': 1, 'type_name': 'host',
+                          'weight': 65536 * len(items), 'alg': 'straw', 'hash': 'rjenkins1', 'items': items})
+        root = {'id': -1, 'name': 'default', 'type_id': 10, 'type_name': 'root',
+                'weight': sum(host['weight'] for host in hosts), 'alg': 'straw', 'hash': 'rjenkins1',
+                'items': [{'id': host['id'], 'weight': host['weight'], 'pos': pos} for pos, host in enumerate(hosts)]}
+        return {
+            'devices': [{'id': osd['id'], 'name': 'osd.%d' % osd['id']} for osd in self.osds],
+            'types': self.crush_types(),
+            'buckets': [root] + hosts,
+            'rules': [{'rule_id': 0, 'rule_name': 'replicated_ruleset', 'ruleset': 0, 'type': 1,
+                       'min_size': 1, 'max_size': 10,
+                       'steps': [{'op': 'take', 'item': -1, 'item_name': 'default'},
+                                 {'op': 'chooseleaf_firstn', 'num': 0, 'type': 'host'},
+                                 {'op': 'emit'}]}],
+            'tunables': {'choose_local_tries': 0, 'choose_total_tries': 50, 'chooseleaf_descend_once': 1},
+        }
+
+    def crush_types(self):
+        return [{'id': 0, 'name': 'osd'}, {'id': 1, 'name': 'host'}, {'id': 10, 'name': 'root'}]
+
+    def crush_nodes(self):
+        return [{'id': bucket['id'], 'name': bucket['name'], 'bucket_type': bucket['type_name'],
+                 'hash': bucket['hash'], 'alg': bucket['alg'], 'weight': bucket['weight'] / 65536.0,
+                 'items': [{'id': item['id'], 'weight': item['weight'] / 65536.0, 'pos': item['pos']}
+                           for item in bucket['items']]}
+                for bucket in self.crush_map()['buckets']]
+
+    def sync_object(self, sync_type):
+        if sync_type == 'osd_map':
+            return {'epoch': self.versions['osd_map'], 'fsid': self.fsid,
+                    'osds': [{'osd': osd['id'], 'uuid': osd['uuid'], 'up': int(osd['up']), 'in': int(osd['in']),
+                              'weight': osd['reweight'], 'primary_affinity': 1.0, 'public_addr': osd['public_addr'],
+                              'cluster_addr': osd['cluster_addr'], 'state': ['exists', 'up'] if osd['up'] else ['exists']}
+                             for osd in self.osds],
+                    'pools': [{'pool': pool['id'], 'pool_name': pool['name'], 'size': pool['size'],
+                               'min_size': pool['min_size'], 'pg_num': pool['pg_num'],
+                               'crush_ruleset': pool['crush_ruleset']} for pool in self.pools],
+                    'crush': self.crush_map()}
+        if sync_type == 'mon_status':
+            return {'epoch': self.versions['mon_status'], 'quorum': list(range(len(self.mons))),
+                    'monmap': {'mons': [{'name': mon['name'], 'rank': mon['rank'], 'addr': mon['addr']}
+                                        for mon in self.mons]}}
+        if sync_type == 'health':
+            return {'overall_status': 'HEALTH_OK', 'summary': [], 'detail': []}
+        if sync_type == 'pg_summary':
+            return {'by_pool': dict((str(pool['id']), {'active+clean': pool['pg_num']}) for pool in self.pools),
+                    'all': {'active+clean': sum(pool['pg_num'] for pool in self.pools)}}
+        if sync_type == 'mds_map':
+            return {'epoch': self.versions['mds_map'], 'up': {}, 'info': {}}
+        if sync_type == 'config':
+            return self.config()
+        return None
+
+    def config(self):
+        return {'auth_mon_ticket_ttl': '43200', 'osd_pool_default_size': '3', 'mon_osd_full_ratio': '0.95'}
+
+
+class FakeCalamari(object):
+    """
+    State of the fake server: clusters, graphite namespace, users, keys
+
+    :arg latency: seconds added to every response (plus up to `jitter`)
+    :arg graphite_days: days of graphite history served
+    :arg max_data_points: honour the maxDataPoints render param (averages)
+    :arg compress: gzip responses over 1 KiB to clients accepting it
+    :arg max_concurrent: answer 503 to the requests over this many in flight,
+                         to simulate an overloaded server
+    :arg request_page_size: paginate request lists ({'count', 'next',
+                            'previous', 'results'}, newest first) like the v2 API
+    """
+    def __init__(self, clusters=1, osds=100, servers=10, mons=3, pools=4, graphite_days=7,
+                 latency=0.0, jitter=0.0, cpus=4, disks=4, nics=2, username='admin', password='admin',
+                 max_data_points=True, compress=True, max_concurrent=None, request_page_size=None):
+        self.clusters = collections.OrderedDict(
+            (cluster.fsid, cluster) for cluster in
+            [FakeCluster(str(uuid.UUID(int=i + 1)), 'ceph%d' % i, osds, servers, mons, pools, seed=i)
+             for i in range(clusters)])
+        self.graphite_days = graphite_days
+        self.max_data_points = max_data_points
+        self.compress = compress
+        self.max_concurrent = max_concurrent
+        self.request_page_size = request_page_size
+        self.latency = latency
+        self.jitter = jitter
+        self.cpus, self.disks, self.nics = cpus, disks, nics
+        self.username, self.password = username, password
+        self.sessions = set()
+        self.request_count = 0
+        self.bytes_sent = 0
+        self.inflight = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    # graphite
+
+    def metric_children(self, path):
+        """
+        Children names of a metric path (list of segments), and whether they are leaves
+        """
+        depth = len(path)
+        if depth == 0:
+            return ['ceph', 'servers'], False
+        if path[0] == 'servers':
+            if depth == 1:
+                return [s['fqdn'].replace('.', '_') for c in self.clusters.values() for s in c.servers], False
+            if depth == 2:
+                return ['cpu', 'iostat', 'loadavg', 'memory', 'network'], False
+            kind = path[2]
+            if depth == 3:
+                return {
+                    'cpu': ['total'] + ['cpu%d' % i for i in range(self.cpus)],
+                    'iostat': ['sd%s' % chr(97 + i) for i in range(self.disks)],
+                    'network': ['eth%d' % i for i in range(self.nics)],
+                    'loadavg': ['01', '05', '15'],
+                    'memory': ['Active', 'Buffers', 'Cached', 'MemFree'],
+                }.get(kind, []), kind in ('loadavg', 'memory')
+            if depth == 4:
+                return {
+                    'cpu': ['system', 'user', 'nice', 'idle', 'iowait', 'irq', 'softirq', 'steal'],
+                    'iostat': ['read_byte_per_second', 'write_byte_per_second', 'read_await',
+                               'write_await', 'iops'],
+                    'network': ['tx_byte', 'rx_byte', 'tx_packets', 'rx_packets', 'tx_errors',
+                                'rx_errors', 'tx_drops', 'rx_drops'],
+                }.get(kind, []), True
+            return [], True
+        if path[0] == 'ceph':
+            if depth == 1:
+                return ['cluster'], False
+            if depth == 2:
+                return list(self.clusters), False
+            cluster = self.clusters.get(path[2])
+            if cluster is None:
+                return [], True
+            if depth == 3:
+                return ['df', 'pool'], False
+            if depth == 4:
+                if path[3] == 'df':
+                    return ['total_avail', 'total_used', 'total_avail_bytes', 'total_used_bytes'], True
+                return ['all'] + [str(pool['id']) for pool in cluster.pools], False
+            if depth == 5:
+                return ['num_read', 'num_write'], True
+        return [], True
+
+    def metrics_find(self, query):
+        parts = query.split('.')
+        matches = [[]]
+        for index, part in enumerate(parts):
+            found = []
+            for path in matches:
+                names, leaf = self.metric_children(path)
+                for name in names:
+                    if fnmatch.fnmatchcase(name, part):
+                        found.append((path + [name], leaf))
+            if index < len(parts) - 1:
+                matches = [path for path, leaf in found if not leaf]
+        result = []
+        for path, leaf in found:
+            result.append({'id': '.'.join(path), 'text': path[-1], 'leaf': int(leaf),
+                           'expandable': int(not leaf), 'allowChildren': int(not leaf), 'context': {}})
+        return result
+
+    def graphite_time(self, value, now):
+        if value is None:
+            return now
+        value = str(value)
+        if value.startswith('-'):
+            match = re.match(r'^-(\d+)([a-z]+)$', value)
+            number, unit = int(match.group(1)), match.group(2)
+            for prefix, seconds in [('min', 60), ('mon', 30 * 86400), ('s', 1), ('h', 3600),
+                                    ('d', 86400), ('w', 7 * 86400), ('y', 365 * 86400)]:
+                if unit.startswith(prefix):
+                    return now - number * seconds
+        if value == 'now':
+            return now
+        return int(float(value))
+
+    def series_seed(self, target):
+        return zlib.crc32(target.encode('utf-8')) & 0xffff
+
+    def series_value(self, seed, ts):
+        if seed % 37 == 0 and (ts // 60) % 97 == 0:
+            return None  # some gaps
+        return round(50 + 40 * math.sin(ts / 3600.0 + seed) + (seed % 10), 3)
+
+    def render(self, targets, time_from, until, max_points=None):
+        now = int(time.time())
+        start = max(self.graphite_time(time_from or '-1d', now), now - self.graphite_days * 86400)
+        end = self.graphite_time(until, now)
+        step = 60 if now - start <= 86400 else 900
+        first = start - start % step + step
+        seeds = [self.series_seed(target) for target in targets]
+        datapoints = []
+        for ts in range(first, end + 1, step):
+            datapoints.append([ts] + [self.series_value(seed, ts) for seed in seeds])
+        if max_points and self.max_data_points and len(datapoints) > max_points:
+            per_point = -(-len(datapoints) // max_points)
+            consolidated = []
+            for i in range(0, len(datapoints), per_point):
+                group = datapoints[i:i + per_point]
+                row = [group[0][0]]
+                for column in range(1, len(targets) + 1):
+                    values = [r[column] for r in group if r[column] is not None]
+                    row.append(sum(values) / len(values) if values else None)
+                consolidated.append(row)
+            datapoints = consolidated
+        return {'targets': targets, 'datapoints': datapoints}
+
+    # REST routes
+
+    def route(self, method, path, query, body):
+        """
+        (status, payload) of an authenticated API request
+        """
+        parts = [part for part in path.split('/') if part]
+        if parts[:1] == ['graphite']:
+            if parts[1:2] == ['render']:
+                params = dict(query)
+                return 200, self.render([v for k, v in query if k == 'target'],
+                                        params.get('from'), params.get('until'),
+                                        int(params['maxDataPoints']) if 'maxDataPoints' in params else None)
+            if parts[1:2] == ['metrics']:
+                return 200, self.metrics_find(dict(query).get('query', '*'))
+            return 404, {'detail': 'Not found'}
+        if parts[:1] != ['api'] or len(parts) < 3:
+            return 404, {'detail': 'Not found'}
+        version, parts = parts[1], parts[2:]
+        params = dict(query)
+        if parts == ['info']:
+            return 200, {'version': '1.3.1', 'license': 'N/A', 'registered': 'N/A',
+                         'hostname': 'calamari', 'fqdn': 'calamari.example.com', 'ipaddr': '127.0.0.1'}
+        if parts == ['cluster']:
+            return 200, [cluster.summary() for cluster in self.clusters.values()]
+        if parts[0] == 'cluster':
+            cluster = self.clusters.get(parts[1])
+            if cluster is None:
+                return 404, {'detail': 'Cluster not found'}
+            return self.route_cluster(version, method, cluster, parts[2:], params, body)
+        if version == 'v1':
+            return 404, {'detail': 'Not found'}
+        servers = dict((s['fqdn'], s) for c in self.clusters.values() for s in c.servers)
+        if parts == ['server']:
+            return 200, list(servers.values())
+        if parts[0] == 'server':
+            server = servers.get(parts[1])
+            if server is None:
+                return 404, {'detail': 'Server not found'}
+            if len(parts) == 2:
+                return 200, server
+            if parts[2] == 'grains':
+                return 200, {'fqdn': server['fqdn'], 'host': server['hostname'], 'os': 'CentOS',
+                             'osrelease': '7.2.1511', 'num_cpus': self.cpus, 'mem_total': 64000}
+            if parts[2] == 'event':
+                return 200, []
+            if parts[2] == 'log':
+                if len(parts) == 3:
+                    return 200, ['ceph/ceph.log', 'ceph/ceph-osd.0.log']
+                lines = int(params.get('lines', 10))
+                return 200, {'lines': '\n'.join(next(iter(self.clusters.values())).log[-lines:])}
+        if parts == ['event']:
+            return 200, [event for cluster in self.clusters.values() for event in cluster.events]
+        if parts[0] == 'request':
+            requests_ = dict((k, v) for c in self.clusters.values() for k, v in c.requests.items())
+            if len(parts) == 1:
+                return 200, self.list_requests(list(requests_.values()), params)
+            request = requests_.get(parts[1])
+            if request is None:
+                return 404, {'detail': 'Request not found'}
+            if len(parts) == 3 and parts[2] == 'cancel' and method == 'POST':
+                request['state'] = 'complete'
+                request['error'] = True
+                request['error_message'] = 'Cancelled'
+            return 200, self.filter_requests([request], {})[0]
+        if parts[0] == 'key':
+            keys = [{'id': s['fqdn'], 'status': 'accepted'} for c in self.clusters.values() for s in c.servers]
+            if len(parts) == 1:
+                return 200, keys
+            return 200, {'id': parts[1], 'status': 'accepted'}
+        if parts[0] == 'user':
+            user = {'id': 1, 'username': self.username, 'email': ''}
+            return 200, [user] if len(parts) == 1 else user
+        if parts == ['grains']:
+            return 200, {'fqdn': 'calamari.example.com'}
+        return 404, {'detail': 'Not found'}
+
+    def filter_requests(self, requests_, params):
+        now = time.time()
+        for request in requests_:
+            if request['state'] == 'submitted' and now >= request['_complete_at']:
+                request['state'] = 'complete'
+                request['completed_at'] = now
+        if params.get('state'):
+            requests_ = [r for r in requests_ if r['state'] == params['state']]
+        return [dict((k, v) for k, v in r.items() if not k.startswith('_')) for r in requests_]
+
+    def list_requests(self, requests_, params):
+        requests_ = self.filter_requests(requests_, params)
+        if self.request_page_size is None:
+            return requests_
+        page = int(params.get('page', 1))
+        requests_.sort(key=lambda r: r.get('requested_at') or 0, reverse=True)
+        start = (page - 1) * self.request_page_size
+        more = start + self.request_page_size < len(requests_)
+        return {'count': len(requests_),
+                'next': '?page=%d' % (page + 1, ) if more else None,
+                'previous': '?page=%d' % (page - 1, ) if page > 1 else None,
+                'results': requests_[start:start + self.request_page_size]}
+
+    def route_cluster(self, version, method, cluster, parts, params, body):
+        if not parts:
+            return 200, cluster.summary()
+        kind, rest = parts[0], parts[1:]
+        by_key = {
+            'osd': (lambda: cluster.osds, 'uuid' if version == 'v1' else 'id'),
+            'pool': (lambda: cluster.pools, 'id'),
+            'server': (lambda: cluster.servers, 'fqdn'),
+            'mon': (lambda: cluster.mons, 'name'),
+            'crush_node': (cluster.crush_nodes, 'id'),
+            'crush_type': (cluster.crush_types, 'id'),
+        }
+        if kind in by_key:
+            items, key = by_key[kind]
+            items = items()
+            if not rest:
+                if kind == 'osd' and version == 'v1':
+                    return 200, {'osds': items, 'pg_state_counts': {}}
+                return 200, items
+            found = [item for item in items if str(item[key]) == rest[0]]
+            if not found:
+                return 404, {'detail': 'Not found'}
+            if kind == 'mon' and rest[1:] == ['status']:
+                return 200, {'name': found[0]['name'], 'rank': found[0]['rank'], 'state': 'leader'}
+            return 200, found[0]
+        if kind in ('health', 'health_counters', 'space'):
+            return 200, {'health': cluster.sync_object('health'), 'space': {'used_bytes': 0, 'capacity_bytes': 0},
+                         'counters': {}}.get(kind, {})
+        if kind == 'config':
+            config = cluster.config()
+            if not rest:
+                return 200, [{'key': k, 'value': v} for k, v in sorted(config.items())]
+            return 200, {'key': rest[0], 'value': config.get(rest[0])}
+        if kind == 'crush_map':
+            return 200, cluster.crush_map()
+        if kind in ('crush_rule', 'crush_rule_set'):
+            return 200, cluster.crush_map()['rules']
+        if kind == 'event':
+            return 200, cluster.events
+        if kind == 'log':
+            lines = int(params.get('lines', 10))
+            return 200, {'lines': '\n'.join(cluster.log[-lines:])}
+        if kind == 'osd_config':
+            return 200, {'noout': False, 'noin': False, 'noup': False, 'nodown': False,
+                         'pause': False, 'noscrub': False, 'nodeep-scrub': False}
+        if kind == 'sync_object':
+            if not rest:
+                return 200, list(SYNC_TYPES)
+            data = cluster.sync_object(rest[0])
+            return (200, data) if data is not None else (404, {'detail': 'Not found'})
+        if kind == 'request':
+            if not rest:
+                return 200, self.list_requests(list(cluster.requests.values()), params)
+            request = cluster.requests.get(rest[0])
+            if request is None:
+                return 404, {'detail': 'Not found'}
+            return 200, self.filter_requests([request], {})[0]
+        if kind == 'cli' and method == 'POST':
+            command = json.loads(body or '{}').get('command')
+            return 200, {'out': 'fake output of %r' % (command, ), 'err': '', 'status': 0}
+        return 404, {'detail': 'Not found'}
+
+    def submit_request(self, fsid, duration=1.0):
+        """
+        Create a fake asynchronous request completing after duration seconds
+        """
+        cluster = self.clusters[fsid]
+        request_id = str(uuid.uuid4())
+        cluster.requests[request_id] = {
+            'id': request_id, 'state': 'submitted', 'error': False, 'error_message': '',
+            'headline': 'Fake request', 'status': 'Running', 'requested_at': time.time(),
+            'completed_at': None, '_complete_at': time.time() + duration,
+        }
+        return request_id
+
+
+class FakeCalamariHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes, avoid delayed ACK stalls
+    disable_nagle_algorithm = True
+    fake = None  # FakeCalamari, set by make_server
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, payload, cookie=None):
+        body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        encoding = None
+        if (self.fake.compress and len(body) > 1024 and
+                'gzip' in (self.headers.get('Accept-Encoding') or '')):
+            compressor = zlib.compressobj(1, zlib.DEFLATED, 31)  # gzip container
+            body = compressor.compress(body) + compressor.flush()
+            encoding = 'gzip'
+        with self.fake._lock:
+            self.fake.bytes_sent += len(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        if cookie is not None:
+            self.send_header('Set-Cookie', '%s=%s; Path=/' % (SESSION_COOKIE, cookie))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def session(self):
+        for part in (self.headers.get('Cookie') or '').split(';'):
+            name, _, value = part.strip().partition('=')
+            if name == SESSION_COOKIE and value in self.fake.sessions:
+                return value
+        return None
+
+    def handle_request(self, method):
+        fake = self.fake
+        with fake._lock:
+            fake.request_count += 1
+            overloaded = fake.max_concurrent is not None and fake.inflight >= fake.max_concurrent
+            if overloaded:
+                fake.rejected += 1
+            else:
+                fake.inflight += 1
+        if overloaded:
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                self.rfile.read(length)
+            return self.send_json(503, {'detail': 'Service unavailable, try again later.'})
+        try:
+            self._handle_request(method)
+        finally:
+            with fake._lock:
+                fake.inflight -= 1
+
+    def _handle_request(self, method):
+        fake = self.fake
+        if fake.latency or fake.jitter:
+            time.sleep(fake.latency + random.random() * fake.jitter)
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        if method == 'POST' and url.path.rstrip('/').endswith('/auth/login'):
+            form = dict(parse_qsl(body))
+            if form.get('username') != fake.username or form.get('password') != fake.password:
+                return self.send_json(401, {'message': 'Invalid credentials'})
+            session = uuid.uuid4().hex
+            fake.sessions.add(session)
+            return self.send_json(200, {}, cookie=session)
+        session = self.session()
+        if session is None:
+            return self.send_json(403, {'detail': 'Authentication credentials were not provided.'})
+        if method == 'POST' and url.path.rstrip('/').endswith('/auth/logout'):
+            fake.sessions.discard(session)
+            return self.send_json(200, {'message': 'Logged out'})
+        try:
+            status, payload = fake.route(method, url.path, parse_qsl(url.query), body)
+        except Exception as e:
+            status, payload = 500, {'detail': repr(e)}
+        self.send_json(status, payload)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+def make_server(fake, host='127.0.0.1', port=0):
+    """
+    HTTP server of fake, port 0 picks a free port (see server.server_port)
+    """
+    handler = type('Handler', (FakeCalamariHandler, ), {'fake': fake})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def serve_in_thread(fake, host='127.0.0.1', port=0):
+    """
+    Start a server of fake in a daemon thread, return (server, base url)
+    """
+    server = make_server(fake, host, port)
+    thread = threading.Thread(target=server.serve_forever, name='fake-calamari')
+    thread.daemon = True
+    thread.start()
+    return server, 'http://%s:%d/' % (host, server.server_port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local fake Calamari server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--clusters', type=int, default=1)
+    parser.add_argument('--osds', type=int, default=100)
+    parser.add_argument('--servers', type=int, default=10)
+    parser.add_argument('--mons', type=int, default=3)
+    parser.add_argument('--pools', type=int, default=4)
+    parser.add_argument('--graphite-days', type=int, default=7)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra seconds, up to')
+    parser.add_argument('--no-compress', dest='compress', action='store_false', help='never gzip responses')
+    parser.add_argument('--max-concurrent', type=int, help='answer 503 to the requests over this many in flight')
+    args = parser.parse_args()
+    fake = FakeCalamari(clusters=args.clusters, osds=args.osds, servers=args.servers, mons=args.mons,
+                        pools=args.pools, graphite_days=args.graphite_days,
+                        latency=args.latency, jitter=args.jitter, compress=args.compress,
+                        max_concurrent=args.max_concurrent)
+    server = make_server(fake, args.host, args.port)
+    print('Fake Calamari on http://%s:%d/ (user %s / %s)' % (args.host, server.server_port,
+                                                             fake.username, fake.password))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
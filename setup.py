@@ -13,16 +13,24 @@ kwargs = {}
 version = "0.1"
 
 if setuptools is not None:
-    install_requires = ['requests']
+    install_requires = ['requests', 'futures; python_version < "3"']
     kwargs['install_requires'] = install_requires
+    kwargs['extras_require'] = {
+        'aio': ['aiohttp'],
+        'numpy': ['numpy'],
+        'fast': ['orjson'],
+    }
+    kwargs['entry_points'] = {
+        'console_scripts': ['calamari-export = calamari_export:main'],
+    }
 
 setup(
     name="calamari_client",
     version=version,
-    py_modules=["calamari_client"],
+    py_modules=["calamari_client", "calamari_client_aio", "calamari_export"],
     author="Blahhhhh",
     url="https://github.com/Blahhhhh/python-calamari-client/",
     license="https://opensource.org/licenses/MIT",
     description="Ceph Manager API Python Client",
     **kwargs
-)
\ No newline at end of file
+)